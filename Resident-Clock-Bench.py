@@ -0,0 +1,224 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import argparse
+import asyncio
+import datetime
+import importlib.util
+import tracemalloc
+from time import perf_counter
+from aiohttp import web
+
+#Offline benchmark for Resident Clock's commands. The real command functions are called with a stand-in for Discord's ctx, and every
+#API request goes to a local server that replays the responses recorded in Resident-Clock-Bench-Fixtures.json, so no bot token,
+#API key or network connection is needed. Runs against a scratch copy of the data files, the real ones are never touched.
+#Usage: python Resident-Clock-Bench.py [--iterations 200] [--cold] [--only forecast,time] [--save results.json]
+
+BOT_FILE = 'Resident-Clock.py'
+FIXTURES_FILE = 'Resident-Clock-Bench-Fixtures.json'
+DATA_FILES = ['Resident-Clock-Config.json', 'Resident-Clock-Help.json', 'Resident-Clock-Quotes.json', 'Resident-Clock-Cities.tsv']
+BENCH_GUILD = 800098126693138470
+BENCH_USERS = (300000000000000000, 300000000047514078)  #both on the recorded leaderboard
+ALLOCATION_SAMPLES = 20 #calls traced per command, tracing is slow so it's kept apart from the timed calls
+
+#each benchmark is a label, the command's name in the bot file and the arguments it's called with
+BENCHMARKS = [
+    ("forecast", 'forecast', ()),
+    ("forecast 5", 'forecast', ("5",)),
+    ("temperature", 'temperature', ()),
+    ("AQI", 'cAQI', ()),
+    ("detailed_AQI", 'dAQI', ()),
+    ("time", 'time', ()),
+    ("help", 'help', ()),
+    ("help forecast", 'help', ("forecast",)),
+    ("quote", 'quote', ()),
+    ("moonie", 'moonie', ()),
+    ("moonie month", 'moonie', ("month",)),
+    ("cmpxp", 'compareXP', (str(BENCH_USERS[0]), str(BENCH_USERS[1]))),
+    ("meow", 'catAPI', ()),
+    ("woof", 'dogAPI', ()),
+]
+
+#just enough of discord.py's Context for the commands to run. Everything sent is kept so the output can be checked afterwards.
+class FakeUser:
+    def __init__(self, userID):
+        self.id = userID
+        self.display_name = "member" + str(userID)[-4:]
+        self.mention = "<@" + str(userID) + ">"
+
+class FakeGuild:
+    def __init__(self, guildID):
+        self.id = guildID
+        self.name = "Benchmark Server"
+
+    def get_member(self, userID):
+        return FakeUser(userID)
+
+class FakeMessage:
+    def __init__(self, guild, author):
+        self.guild = guild
+        self.author = author
+
+    async def delete(self):
+        pass
+
+class FakeContext:
+    def __init__(self, guildID, userID):
+        self.guild = FakeGuild(guildID)
+        self.author = FakeUser(userID)
+        self.message = FakeMessage(self.guild, self.author)
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append((content, kwargs))
+
+#loads the bot file as a module without connecting to Discord
+def loadBot(workdir):
+    os.chdir(workdir)
+    os.environ.pop('RESIDENT_CLOCK_SHARD_IDS', None)
+    spec = importlib.util.spec_from_file_location("residentclock", os.path.join(sourceDir, BOT_FILE))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+#The recorded forecast is shifted so that it starts now, otherwise "today" would fall outside of it once the recording gets old
+def rebaseForecast(forecast):
+    step = 3 * 3600
+    start = (int(datetime.datetime.now(datetime.timezone.utc).timestamp()) // step + 1) * step
+    shift = start - forecast['list'][0]['dt']
+    for entry in forecast['list']:
+        entry['dt'] += shift
+        entry['dt_txt'] = datetime.datetime.fromtimestamp(entry['dt'], datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    return forecast
+
+async def startStubServer(fixtures):
+    forecast = json.dumps(rebaseForecast(fixtures['forecast']))
+    aqi = json.dumps(fixtures['aqi'])
+    mee6 = json.dumps(fixtures['mee6'])
+    served = [0]
+
+    #every picture gets its own URL, like the real APIs, so the bot's image pool doesn't throw them away as repeats
+    def images(request):
+        batch = []
+        for i in range(int(request.query.get('limit', 1))):
+            served[0] += 1
+            batch.append({"id": str(served[0]), "url": "https://cdn2.thecatapi.com/images/" + str(served[0]) + ".jpg", "width": 800, "height": 600})
+        return web.Response(text=json.dumps(batch), content_type="application/json")
+
+    app = web.Application()
+    app.router.add_get('/forecast', lambda request: web.Response(text=forecast, content_type="application/json"))
+    app.router.add_get('/aqi/{city}/', lambda request: web.Response(text=aqi, content_type="application/json"))
+    app.router.add_get('/mee6/{guild}', lambda request: web.Response(text=mee6, content_type="application/json"))
+    app.router.add_get('/images', images)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, "http://127.0.0.1:" + str(port)
+
+def pointAtStub(bot, base):
+    bot.WEATHER_URL = base + "/forecast"
+    bot.AQI_URL = base + "/aqi/"
+    bot.MEE6_URL = base + "/mee6/"
+    bot.CAT_URL = base + "/images"
+    bot.DOG_URL = base + "/images"
+    bot.catImages.url = bot.CAT_URL
+    bot.dogImages.url = bot.DOG_URL
+    bot.quotas = bot.QuotaManager({}) #the stub has no rate limits, and the benchmark would otherwise spend most of its time waiting on them
+
+def clearCaches(bot):
+    for cache in (bot.forecastCache, bot.aqiCache, bot.leaderboardCache):
+        cache.entries.clear()
+    for pool in (bot.catImages, bot.dogImages):
+        pool.urls.clear()
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+async def runBenchmark(bot, command, args, iterations, cold):
+    callback = getattr(bot, command).callback
+    ctx = FakeContext(BENCH_GUILD, BENCH_USERS[1])
+    await callback(ctx, *args) #warm up, and fill the caches for the hot runs
+
+    timings = []
+    started = perf_counter()
+    for i in range(iterations):
+        if cold:
+            clearCaches(bot)
+        before = perf_counter()
+        await callback(ctx, *args)
+        timings.append(perf_counter() - before)
+    elapsed = perf_counter() - started
+
+    peaks = []
+    tracemalloc.start()
+    for i in range(ALLOCATION_SAMPLES):
+        if cold:
+            clearCaches(bot)
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        await callback(ctx, *args)
+        peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    tracemalloc.stop()
+
+    timings.sort()
+    last = ctx.sent[-1]
+    return {
+        'ops': iterations / elapsed,
+        'p50': percentile(timings, 0.5) * 1000,
+        'p99': percentile(timings, 0.99) * 1000,
+        'kib': sum(peaks) / len(peaks) / 1024,
+        'output': last[0] if last[0] is not None else (last[1]['embed'].title or last[1]['embed'].description or last[1]['embed'].image.url),
+    }
+
+async def main(options):
+    with open(os.path.join(sourceDir, FIXTURES_FILE)) as json_file:
+        fixtures = json.load(json_file)
+    workdir = tempfile.mkdtemp(prefix="resident-clock-bench-")
+    try:
+        for name in DATA_FILES:
+            if os.path.exists(os.path.join(sourceDir, name)):
+                shutil.copy(os.path.join(sourceDir, name), workdir)
+        with open(os.path.join(workdir, 'Resident-Clock-Defaults.json'), 'w') as json_file:
+            json.dump({'per_server': []}, json_file)
+
+        bot = loadBot(workdir)
+        bot.settings.add(bot.newServerDefaults(BENCH_GUILD))
+        runner, base = await startStubServer(fixtures)
+        pointAtStub(bot, base)
+
+        selected = [b for b in BENCHMARKS if not options.only or b[0].split()[0] in options.only or b[1] in options.only]
+        results = {}
+        print("%-16s %12s %10s %10s %12s   %s" % ("command", "ops/sec", "p50 ms", "p99 ms", "peak KiB", "output"))
+        for label, command, args in selected:
+            result = await runBenchmark(bot, command, args, options.iterations, options.cold)
+            results[label] = result
+            print("%-16s %12.1f %10.3f %10.3f %12.1f   %s" % (label, result['ops'], result['p50'], result['p99'], result['kib'], str(result['output'])[:40]))
+
+        for hook in reversed(bot.shutdownHooks): #same order as the bot shutting down
+            await hook()
+        await runner.cleanup()
+    finally:
+        os.chdir(sourceDir)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if options.save:
+        with open(options.save, 'w') as json_file:
+            json.dump({'iterations': options.iterations, 'cold': options.cold, 'python': sys.version.split()[0], 'results': results}, json_file, indent='\t')
+        print("saved to " + options.save)
+
+sourceDir = os.path.dirname(os.path.abspath(__file__))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks Resident Clock's commands against recorded API responses.")
+    parser.add_argument('--iterations', type=int, default=200, help="timed calls per command")
+    parser.add_argument('--cold', action='store_true', help="empty the caches before every call, so each one goes to the stub server")
+    parser.add_argument('--only', type=lambda text: text.split(","), default=None, help="comma separated commands to run, e.g. forecast,time")
+    parser.add_argument('--save', help="write the results to a JSON file, to compare against a later run")
+    options = parser.parse_args()
+    if options.save:
+        options.save = os.path.abspath(options.save)
+    asyncio.run(main(options))
@@ -0,0 +1,82 @@
+import os
+import sys
+import json
+import signal
+import subprocess
+import time
+
+#Runs Resident Clock as several processes, each one connecting a share of the bot's shards. Every process gets its shard IDs through
+#RESIDENT_CLOCK_SHARD_IDS and the total through RESIDENT_CLOCK_SHARD_COUNT, and they share settings and API data through SQLite.
+#Usage: python Resident-Clock-Launcher.py [processes] [shards]
+#Both default to the "Processes" and "ShardCount" config entries, then to the number of CPU cores.
+
+RESTART_DELAY = 5       #seconds to wait before bringing a crashed process back
+RESTART_DELAY_MAX = 300 #repeated crashes back off up to this long
+STABLE_AFTER = 600      #a process that stayed up this long gets its backoff reset
+
+with open('Resident-Clock-Config.json') as json_file:
+    options = {}
+    for d in json.load(json_file)['general']:
+        options.update(d)
+
+processCount = int(sys.argv[1]) if len(sys.argv) > 1 else int(options.get('Processes', os.cpu_count() or 1))
+shardCount = int(sys.argv[2]) if len(sys.argv) > 2 else int(options.get('ShardCount', processCount))
+processCount = max(1, min(processCount, shardCount))
+
+#shards are dealt out round robin, so process 0 of 2 runs shards 0, 2, 4... and process 1 runs 1, 3, 5...
+groups = [[shard for shard in range(shardCount) if shard % processCount == n] for n in range(processCount)]
+
+children = [None] * processCount
+started = [0] * processCount
+delays = [RESTART_DELAY] * processCount
+restartAt = [0] * processCount
+stopping = False
+
+def spawn(n):
+    env = dict(os.environ)
+    env['RESIDENT_CLOCK_SHARD_IDS'] = ",".join(str(shard) for shard in groups[n])
+    env['RESIDENT_CLOCK_SHARD_COUNT'] = str(shardCount)
+    children[n] = subprocess.Popen([sys.executable, 'Resident-Clock.py'], env=env)
+    started[n] = time.monotonic()
+    print("process " + str(n) + " (pid " + str(children[n].pid) + ") running shards " + env['RESIDENT_CLOCK_SHARD_IDS'])
+
+#the bot saves its settings on SIGTERM, so the signal is passed on and the children are given time to finish
+def stop(signum, frame):
+    global stopping
+    stopping = True
+    for child in children:
+        if child is not None and child.poll() is None:
+            child.send_signal(signal.SIGTERM)
+
+signal.signal(signal.SIGTERM, stop)
+signal.signal(signal.SIGINT, stop)
+
+#each process opens its own gateway connections, so they're started a few seconds apart to stay inside Discord's identify limit
+for n in range(processCount):
+    if stopping:
+        break
+    spawn(n)
+    if n < processCount - 1:
+        time.sleep(RESTART_DELAY)
+
+while not stopping:
+    time.sleep(1)
+    for n, child in enumerate(children):
+        if stopping:
+            break
+        if child is not None:
+            code = child.poll()
+            if code is None:
+                continue
+            if time.monotonic() - started[n] > STABLE_AFTER:
+                delays[n] = RESTART_DELAY
+            print("process " + str(n) + " exited with code " + str(code) + ", restarting in " + str(delays[n]) + " seconds")
+            children[n] = None
+            restartAt[n] = time.monotonic() + delays[n]
+            delays[n] = min(delays[n] * 2, RESTART_DELAY_MAX)
+        elif time.monotonic() >= restartAt[n]:
+            spawn(n)
+
+for child in children:
+    if child is not None:
+        child.wait()
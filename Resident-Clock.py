@@ -12,14 +12,30 @@
 
 
 import os
+import sys
+import io
+import threading
 import json
+import signal
 import datetime
-import math, decimal
+import math
+import functools
+import zoneinfo
+import importlib.resources
 import random
-from mee6_py_api.api import API
-from mee6_py_api.utils.logging import setup_logger
+import heapq
+import re
+import difflib
+import unicodedata
+import urllib.parse
+import email.utils
+import sqlite3
+from time import monotonic
+from collections import deque
 import asyncio
-import requests
+import aiohttp
+from aiohttp import web
+import numpy
 import discord
 from discord.ext import commands
 
@@ -36,68 +52,100 @@ with open('Resident-Clock-Config.json') as json_file:
     OwnerID = data['general'][1]['OwnerID']           #ID of the bot owner, used to enable a non-admin bot owner to modify bot settings
     WeatherToken = data['general'][2]['WeatherAPI']   #Token for the weather API
     AQIToken = data['general'][3]['AQI_API']          #Token for the Air Quality Index API
-
-#Used during initialization, is used to preform a clean sweep of the "defaults" file and make sure that each server has a list of usable data
-#this is done for future-proofing, to make sure that all new bot commands have their required default values consistently updated.
-with open('Resident-Clock-Defaults.json') as json_file:
-    data = json.load(json_file)
-    list = data['per_server']
-    for idx, d in enumerate(list):
-        print("checking index: " + str(idx))
-        if "defaultCity" not in d.keys():
-            print("defaultCity not in data, reacquiring.")
-            d1 = {"defaultCity": "Victoria, CA"}
-            d.update(d1)
-        if "AQI_defaultCity" not in d.keys():
-            print("AQI_defaultCity not in data, reacquiring.")
-            d1 = {"AQI_defaultCity": "Victoria"}
-            d.update(d1)
-        if "Timezone" not in d.keys():
-            print("Timezone not in data, reacquiring.")
-            d1 = {"Timezone": 0}
-            d.update(d1)
-        if "ClockChannel" not in d.keys():
-            print("ClockChannel not in data, reacquiring.")
-            d1 = {"ClockChannel": None}
-            d.update(d1)
-        print("All files good, continuing-")
-
-        data['per_server'][idx] = d
-        with open('Resident-Clock-Defaults.json', 'w') as outfile:
-            json.dump(data, outfile)
+    #Optional settings, anything left out of the config file falls back to its default
+    options = {}
+    for d in data['general'][4:]:
+        options.update(d)
+    SettingsBackend = options.get('SettingsBackend', "json")                        #where server defaults are stored, "json" or "sqlite"
+    SettingsDatabase = options.get('SettingsDatabase', "Resident-Clock-Defaults.db") #database file used by the sqlite backend
+    Sharding = options.get('Sharding', "off")                                       #"auto" runs every shard this process is given over its own gateway connection
+    CacheDatabase = options.get('CacheDatabase', "Resident-Clock-Cache.db")          #upstream data shared between processes when running as a cluster
+    MetricsPort = int(options.get('MetricsPort', 9108))                              #local port for the Prometheus metrics page, 0 turns it off
+
+#When started by Resident-Clock-Launcher.py, each process is told which shards it runs. The processes share their settings and upstream
+#data through SQLite, and each one only looks after the servers on its own shards.
+ShardIDs = None
+ShardCount = None
+if os.environ.get('RESIDENT_CLOCK_SHARD_IDS'):
+    ShardIDs = [int(x) for x in os.environ['RESIDENT_CLOCK_SHARD_IDS'].split(",")]
+    ShardCount = int(os.environ['RESIDENT_CLOCK_SHARD_COUNT'])
+    Sharding = "auto"
+    if SettingsBackend != "sqlite":
+        print("cluster mode needs shared settings, using the sqlite backend")
+        SettingsBackend = "sqlite"
+
+#coroutines in here get awaited when the bot shuts down, so anything holding open connections or unsaved data can clean up after itself.
+#They run newest first, so the loops and queues that use the HTTP session and the settings are stopped before those get closed.
+shutdownHooks = []
+
+#same as a regular bot, but it runs the shutdown hooks before disconnecting. Sharded bots open one gateway connection per shard.
+class ResidentClock(commands.AutoShardedBot if Sharding == "auto" else commands.Bot):
+    async def close(self):
+        for hook in reversed(shutdownHooks):
+            try:
+                await hook()
+            except Exception as e:
+                print("shutdown hook failed: " + repr(e))
+        await super().close()
 
 #commands are not case sensitive, help command is handled by custom code. Commands are prefixed by "!"
-bot = commands.Bot(command_prefix='!', help_command=None, case_insensitive=True)
+#Newer versions of discord.py insist on being told the intents, and only deliver message text to prefix commands when asked for it.
+intents = discord.Intents.default()
+if hasattr(intents, 'message_content'):
+    intents.message_content = True
+if ShardIDs is not None:
+    bot = ResidentClock(command_prefix='!', help_command=None, case_insensitive=True, intents=intents, shard_ids=ShardIDs, shard_count=ShardCount)
+else:
+    bot = ResidentClock(command_prefix='!', help_command=None, case_insensitive=True, intents=intents)
+
+#whether a server is handled by this process. Discord assigns servers to shards by (server ID >> 22) % shard count.
+def ownsGuild(serverID):
+    if ShardIDs is None:
+        return True
+    return (int(serverID) >> 22) % ShardCount in ShardIDs
 
 @bot.event
 async def on_ready():
     print(f'{bot.user} has connected to Discord!') #print this to the UI to confirm bot is functional
     await bot.change_presence(activity=discord.Game(name='with time and space')) #set the bot status
-    await clocktower() #begin the clock channel update cycle
+    installSignalHandlers()
+    await startMetricsServer()
+    settings.reconcile(guild.id for guild in bot.guilds)
+    fleet.rebuild(bot.guilds)
+    supervisor.start() #begins the clock channel update cycle and anything else that runs in the background
 
 #comment this to show errors for all Discord-related issues.
 @bot.event
 async def on_command_error(ctx, error):
     if isinstance(error, commands.CommandNotFound):
         return
+    recordCommandError(ctx, error)
+    #an upstream API timed out or refused the connection. Let the user know instead of failing silently
+    if isinstance(error, commands.CommandInvokeError) and isinstance(error.original, UpstreamError):
+        embedVar = discord.Embed(description=("Error: " + str(error.original)), color=0xFF0000)
+        await ctx.send(embed=embedVar)
+
+#What to do when the bot leaves a server, or gets kicked from it. Its settings are kept for a while in case it's invited back.
+@bot.event
+async def on_guild_remove(guild):
+    fleet.remove(guild)
+    entry = settings.leave(guild.id)
+    if entry is not None and entry['ClockChannel'] is not None:
+        clockEdits.forget(int(entry['ClockChannel']))
+
+#keeps the owner's server list up to date when a server is renamed
+@bot.event
+async def on_guild_update(before, after):
+    if before.name != after.name:
+        fleet.remove(before)
+        fleet.add(after)
 
 #What to do when the bot joins a new server
 @bot.event
 async def on_guild_join(guild):
-    #create the appropriate file set to store server-specific data
-    with open('Resident-Clock-Defaults.json') as json_file:
-        data = json.load(json_file)
-        newserverdefaults = {
-            'serverID': guild.id,
-            'defaultCity': "Victoria, CA",
-            'AQI_defaultCity': "Victoria",
-            'Timezone': 0,
-            'ClockChannel': None
-        }
-
-        data['per_server'].append(newserverdefaults)
-        with open('Resident-Clock-Defaults.json', 'w') as outfile:
-            json.dump(data, outfile)
+    #create the appropriate set of defaults to store server-specific data, or bring back the old ones if the bot was here before
+    settings.join(guild.id)
+    fleet.add(guild)
 
     #Find the first accessible channel and spout the generic "Welcome message" all bots need to say for some reason.
     for channel in guild.text_channels:
@@ -106,6 +154,1120 @@ async def on_guild_join(guild):
             break
 
 
+#################################################
+
+################ Metrics section ################
+
+
+#Timings and counters for commands, upstream APIs and the clocktower. Prometheus can scrape them from http://127.0.0.1:<MetricsPort>/metrics
+#and the owner can get a summary with "!stats". Nothing here ever leaves the machine on its own.
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)    #latency histogram bucket bounds, in seconds
+METRICS_RECENT = 500    #latest samples kept per series for the percentiles shown in !stats
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(METRICS_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=METRICS_RECENT)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        self.recent.append(seconds)
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+
+    def percentile(self, fraction):
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class Metrics:
+    def __init__(self):
+        self.histograms = {}    #(name, labels) -> Histogram
+        self.counters = {}      #(name, labels) -> count
+        self.gauges = {}        #name -> function returning {labels: value}
+        self.help = {}
+        self.started = monotonic()
+
+    #labels are passed as keyword arguments, e.g. metrics.observe('command_seconds', 0.2, command="forecast")
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def count(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    #gauges are read when the metrics are rendered, so queue depths and cache sizes never go out of date
+    def gauge(self, name, read, help=""):
+        self.gauges[name] = read
+        self.help[name] = help
+
+    def describe(self, name, help):
+        self.help[name] = help
+
+    def counter(self, name, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def series(self, name):
+        return [(dict(labels), histogram) for (seriesName, labels), histogram in self.histograms.items() if seriesName == name]
+
+    #the Prometheus text exposition format
+    def render(self):
+        lines = []
+        def header(name, kind):
+            if self.help.get(name):
+                lines.append("# HELP resident_clock_" + name + " " + self.help[name])
+            lines.append("# TYPE resident_clock_" + name + " " + kind)
+
+        def labelText(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(key + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"' for key, value in pairs) + "}"
+
+        for name in sorted({key[0] for key in self.histograms}):
+            header(name, "histogram")
+            for (seriesName, labels), histogram in sorted(self.histograms.items()):
+                if seriesName != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(METRICS_BUCKETS, histogram.counts):
+                    cumulative += count
+                    lines.append("resident_clock_" + name + "_bucket" + labelText(labels, [("le", bound)]) + " " + str(cumulative))
+                lines.append("resident_clock_" + name + "_bucket" + labelText(labels, [("le", "+Inf")]) + " " + str(histogram.count))
+                lines.append("resident_clock_" + name + "_sum" + labelText(labels) + " " + str(histogram.sum))
+                lines.append("resident_clock_" + name + "_count" + labelText(labels) + " " + str(histogram.count))
+        for name in sorted({key[0] for key in self.counters}):
+            header(name, "counter")
+            for (seriesName, labels), count in sorted(self.counters.items()):
+                if seriesName == name:
+                    lines.append("resident_clock_" + name + labelText(labels) + " " + str(count))
+        for name, read in sorted(self.gauges.items()):
+            header(name, "gauge")
+            for labels, value in sorted(read().items()):
+                lines.append("resident_clock_" + name + labelText(labels) + " " + str(value))
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe('command_seconds', "Time taken by each command, from invocation to completion.")
+metrics.describe('command_errors_total', "Commands that raised an error.")
+metrics.describe('upstream_seconds', "Time taken by requests to upstream APIs.")
+metrics.describe('upstream_errors_total', "Upstream requests that timed out, failed to connect or came back with an error status.")
+metrics.describe('clock_edit_seconds', "Time taken by clock channel renames.")
+metrics.describe('clock_edit_errors_total', "Clock channel renames that Discord refused.")
+metrics.describe('clock_tick_seconds', "Time taken to queue every clock channel for a tick.")
+metrics.describe('clock_tick_drift_seconds', "How late each clocktower tick woke up.")
+metrics.describe('cache_requests_total', "Cache lookups, by result: hit, miss or stale.")
+metrics.gauge('uptime_seconds', lambda: {(): round(monotonic() - metrics.started, 1)}, "Seconds since the bot started.")
+metrics.gauge('guilds', lambda: {(): len(bot.guilds)}, "Servers this process is connected to.")
+
+#the endpoint only listens on the local machine. When running as a cluster each process takes the next port along.
+metricsRunner = None
+
+async def metricsPage(request):
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+async def startMetricsServer():
+    global metricsRunner
+    if metricsRunner is not None or MetricsPort == 0:
+        return
+    app = web.Application()
+    app.router.add_get('/metrics', metricsPage)
+    metricsRunner = web.AppRunner(app, access_log=None)
+    await metricsRunner.setup()
+    port = MetricsPort + (ShardIDs[0] if ShardIDs else 0)
+    try:
+        await web.TCPSite(metricsRunner, '127.0.0.1', port).start()
+    except OSError as e:
+        print("metrics endpoint could not listen on port " + str(port) + ": " + repr(e))
+        return
+    print("metrics available at http://127.0.0.1:" + str(port) + "/metrics")
+
+async def stopMetricsServer():
+    if metricsRunner is not None:
+        await metricsRunner.cleanup()
+
+shutdownHooks.append(stopMetricsServer)
+
+@bot.event
+async def on_command(ctx):
+    ctx.startedAt = monotonic()
+
+@bot.event
+async def on_command_completion(ctx):
+    metrics.observe('command_seconds', monotonic() - ctx.startedAt, command=ctx.command.qualified_name)
+
+#called from on_command_error, failed commands are timed as well so a slow upstream timeout still shows up in the latency
+def recordCommandError(ctx, error):
+    if ctx.command is None:
+        return
+    if hasattr(ctx, 'startedAt'):
+        metrics.observe('command_seconds', monotonic() - ctx.startedAt, command=ctx.command.qualified_name)
+    metrics.count('command_errors_total', command=ctx.command.qualified_name, error=type(getattr(error, 'original', error)).__name__)
+
+
+#A sampling profiler the owner can switch on with "!profile". A separate thread looks at what the event loop's thread is doing every
+#few milliseconds and counts the stacks it sees, so the bot itself isn't slowed down by tracing every call. Stacks that end waiting in
+#the selector are the loop sitting idle, everything else is time spent in commands, the clocktower or discord.py's gateway handling.
+PROFILE_INTERVAL = 0.005    #seconds between samples
+PROFILE_MAX_SECONDS = 120
+PROFILE_TOP = 15            #functions listed in the summary
+
+class SamplingProfiler:
+    def __init__(self):
+        self.running = False
+
+    def sample(self, threadID, seconds, stacks):
+        pause = threading.Event() #never set, only used to sleep between samples
+        deadline = monotonic() + seconds
+        while monotonic() < deadline:
+            frame = sys._current_frames().get(threadID)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(os.path.basename(code.co_filename) + ":" + code.co_name + ":" + str(code.co_firstlineno))
+                frame = frame.f_back
+            if names:
+                stack = ";".join(reversed(names))
+                stacks[stack] = stacks.get(stack, 0) + 1
+            pause.wait(PROFILE_INTERVAL)
+
+    #samples the thread running the event loop for the given time and returns {collapsed stack: samples}
+    async def run(self, seconds):
+        self.running = True
+        stacks = {}
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, self.sample, threading.get_ident(), seconds, stacks)
+        finally:
+            self.running = False
+        return stacks
+
+    #a plain text summary followed by the stacks in the collapsed format flamegraph.pl and speedscope read
+    def report(self, stacks, seconds):
+        total = sum(stacks.values()) or 1
+        idle = sum(count for stack, count in stacks.items() if stack.rsplit(";", 1)[-1].startswith("selectors.py:"))
+        own = {}        #function -> samples where it was the one running
+        inclusive = {}  #function -> samples where it was anywhere on the stack
+        for stack, count in stacks.items():
+            names = stack.split(";")
+            own[names[-1]] = own.get(names[-1], 0) + count
+            for name in set(names):
+                inclusive[name] = inclusive.get(name, 0) + count
+
+        lines = ["Profiled " + str(seconds) + "s, " + str(total) + " samples, event loop busy " + str(round(100 * (total - idle) / total, 1)) + "% of the time", ""]
+        for title, counts in (("Top functions by own time:", own), ("Top functions by total time:", inclusive)):
+            lines.append(title)
+            for name, count in sorted(counts.items(), key=lambda item: -item[1])[:PROFILE_TOP]:
+                lines.append("%6.1f%%  %s" % (100 * count / total, name))
+            lines.append("")
+        lines.append("Collapsed stacks:")
+        lines.extend(stack + " " + str(count) for stack, count in sorted(stacks.items(), key=lambda item: -item[1]))
+        return "\n".join(lines) + "\n"
+
+profiler = SamplingProfiler()
+
+
+#################################################
+
+############## Networking section ###############
+
+
+#Every upstream API call goes through one shared connection pool so that nothing blocks the event loop and connections get reused
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=10, connect=5)
+HTTP_MAX_CONNECTIONS = 100      #total open connections across every API
+HTTP_MAX_PER_HOST = 10          #open connections to a single API host
+httpSession = None
+
+#every API the bot talks to. Resident-Clock-Bench.py points these at a local server that replays recorded responses.
+WEATHER_URL = "https://api.openweathermap.org/data/2.5/forecast"
+AQI_URL = "https://api.waqi.info/feed/"
+MEE6_URL = "https://mee6.xyz/api/plugins/levels/leaderboard/"
+CAT_URL = "https://api.thecatapi.com/v1/images/search"
+DOG_URL = "https://api.thedogapi.com/v1/images/search"
+
+#raised when an upstream API can't be reached or doesn't answer in time
+class UpstreamError(Exception):
+    pass
+
+#raised when an API's request budget is used up and a command would have to wait too long for it
+class QuotaExhausted(UpstreamError):
+    pass
+
+#A simple token bucket, holds up to `capacity` tokens and gets them back at a rate of `capacity` per `period` seconds
+class TokenBucket:
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    def refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    #how long until the next token is available
+    def waitTime(self):
+        self.refill()
+        return max(0, (1 - self.tokens) / self.rate)
+
+#The free API keys only allow so many requests a minute. Every request spends a token from its API's bucket first, and when the bucket
+#is empty requests queue up by priority: people waiting on a command go before background refreshes. A command that would have to wait
+#more than a few seconds fails straight away instead (cached commands fall back to their last known data).
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+QUOTA_MAX_WAIT = 3          #seconds a command is allowed to wait for a token
+QUOTA_LIMITS = {            #requests, per seconds
+    'weather': (50, 60),    #OpenWeatherMap free tier allows 60 a minute
+    'aqi': (500, 60),
+    'cat': (30, 60),
+    'dog': (30, 60),
+    'mee6': (20, 60),
+}
+
+class QuotaManager:
+    def __init__(self, limits):
+        self.buckets = {name: TokenBucket(*limit) for name, limit in limits.items()}
+        self.waiting = {name: [] for name in limits}    #heaps of (priority, arrival, future)
+        self.dispatchers = {}
+        self.arrivals = 0
+        self.blockedUntil = {}  #name -> monotonic time the API said to wait until after a 429
+
+    #how long until the API will take requests again, 0 if it isn't blocked
+    def blockedFor(self, name):
+        return max(0, self.blockedUntil.get(name, 0) - monotonic())
+
+    async def acquire(self, name, priority=PRIORITY_INTERACTIVE):
+        bucket = self.buckets.get(name)
+        if bucket is None:
+            return
+        queue = self.waiting[name]
+        if not queue and not self.blockedFor(name) and bucket.take():
+            return
+        if priority == PRIORITY_INTERACTIVE:
+            ahead = sum(1 for entry in queue if entry[0] <= priority and not entry[2].done())
+            if self.blockedFor(name) + bucket.waitTime() + ahead / bucket.rate > QUOTA_MAX_WAIT:
+                raise QuotaExhausted("I'm a little busy right now, please try again in a minute.")
+        future = asyncio.get_event_loop().create_future()
+        self.arrivals += 1
+        heapq.heappush(queue, (priority, self.arrivals, future))
+        dispatcher = self.dispatchers.get(name)
+        if dispatcher is None or dispatcher.done():
+            self.dispatchers[name] = asyncio.ensure_future(self.dispatch(name))
+        await future
+
+    #hands out tokens to the queue in priority order as they come back
+    async def dispatch(self, name):
+        bucket = self.buckets[name]
+        queue = self.waiting[name]
+        while queue:
+            if queue[0][2].done(): #the caller gave up
+                heapq.heappop(queue)
+            elif self.blockedFor(name):
+                await asyncio.sleep(self.blockedFor(name))
+            elif bucket.take():
+                heapq.heappop(queue)[2].set_result(None)
+            else:
+                await asyncio.sleep(bucket.waitTime())
+
+    #The API told us to slow down, so nothing more is sent until it said it would be ready (its Retry-After header), or for a whole
+    #period of the limit if it didn't say. The bucket is emptied too, so requests trickle back in at the normal rate afterwards.
+    def exhaust(self, name, retryAfter=None):
+        bucket = self.buckets.get(name)
+        if bucket is not None:
+            bucket.refill()
+            bucket.tokens = min(bucket.tokens, 0)
+            wait = retryAfter if retryAfter is not None else bucket.capacity / bucket.rate
+            self.blockedUntil[name] = max(self.blockedUntil.get(name, 0), monotonic() + wait)
+
+    def depth(self, name):
+        return len(self.waiting.get(name, []))
+
+quotas = QuotaManager(QUOTA_LIMITS)
+metrics.gauge('quota_queue_depth', lambda: {(('api', name),): quotas.depth(name) for name in QUOTA_LIMITS}, "Requests waiting on each API's request budget.")
+
+#the session has to be created from inside the running event loop, so it's made on first use
+def getSession():
+    global httpSession
+    if httpSession is None or httpSession.closed:
+        connector = aiohttp.TCPConnector(limit=HTTP_MAX_CONNECTIONS, limit_per_host=HTTP_MAX_PER_HOST, keepalive_timeout=60, ttl_dns_cache=300)
+        httpSession = aiohttp.ClientSession(connector=connector, timeout=HTTP_TIMEOUT)
+    return httpSession
+
+#Retry-After is usually a number of seconds, but may also be an HTTP date
+def retryAfterSeconds(value):
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (email.utils.parsedate_to_datetime(value) - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+#fetches a URL and returns the decoded JSON body. Error bodies are returned as-is since the APIs put their error messages in there.
+#quota names which API's request budget to spend, and priority decides who goes first when it runs low.
+async def httpGet(url, params=None, quota=None, priority=PRIORITY_INTERACTIVE):
+    return (await httpGetWithStatus(url, params, quota, priority))[1]
+
+#same as httpGet but also hands back the HTTP status, for APIs whose error bodies don't say whether the problem is temporary
+async def httpGetWithStatus(url, params=None, quota=None, priority=PRIORITY_INTERACTIVE):
+    if quota is not None:
+        await quotas.acquire(quota, priority)
+    api = quota or urllib.parse.urlsplit(url).hostname
+    started = monotonic()
+    try:
+        async with getSession().get(url, params=params) as response:
+            if response.status == 429 and quota is not None:
+                quotas.exhaust(quota, retryAfterSeconds(response.headers.get('Retry-After')))
+            if response.status >= 400:
+                metrics.count('upstream_errors_total', api=api, reason=str(response.status))
+            return response.status, await response.json(content_type=None)
+    except asyncio.TimeoutError:
+        metrics.count('upstream_errors_total', api=api, reason="timeout")
+        raise UpstreamError("The upstream service took too long to respond, please try again later.")
+    except (aiohttp.ClientError, ValueError):
+        metrics.count('upstream_errors_total', api=api, reason="connection")
+        raise UpstreamError("The upstream service could not be reached, please try again later.")
+    finally:
+        metrics.observe('upstream_seconds', monotonic() - started, api=api)
+
+async def closeSession():
+    if httpSession is not None and not httpSession.closed:
+        await httpSession.close()
+
+shutdownHooks.append(closeSession)
+
+
+#################################################
+
+############## Locations section ################
+
+
+#A bundled index of cities ("Resident-Clock-Cities.tsv") used to tidy up locations before anything is sent to an API.
+#Known cities (by their name or any of their other names, like "Roma" or "Milano") are rewritten to one canonical spelling so they
+#share a cache entry. Anything the index has never heard of is passed along to the API as-is, since the index only holds bigger cities;
+#if the API doesn't know it either, the closest known city is offered as a suggestion.
+CITIES_FILE = 'Resident-Clock-Cities.tsv'
+LOCATION_MATCH_CUTOFF = 0.85    #how similar a name has to be to a known city to be suggested for it
+
+#strips accents, punctuation and capitals, so "Zürich", "zurich" and "Winston-Salem"/"winston salem" look alike
+def foldName(name):
+    name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode().lower()
+    return " ".join(re.sub(r"[-.'`]", " ", name).split())
+
+class Gazetteer:
+    def __init__(self, path):
+        self.cities = {}        #folded name -> [(name, country code, timezone, population)], most populous first
+        self.aliases = {}       #folded alternate name -> same, only used when no city goes by that name first
+        self.countries = set()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as tsv:
+                for line in tsv:
+                    if line.startswith("#") or not line.strip():
+                        continue
+                    name, country, timezone, population, *alternates = line.rstrip("\n").split("\t")
+                    city = (name, country, timezone, int(population))
+                    self.cities.setdefault(foldName(name), []).append(city)
+                    for alternate in (alternates[0].split(";") if alternates and alternates[0] else []):
+                        self.aliases.setdefault(foldName(alternate), []).append(city)
+                    self.countries.add(country)
+        for matches in list(self.cities.values()) + list(self.aliases.values()):
+            matches.sort(key=lambda city: -city[3])
+        self.byLetter = {}      #first letter -> names, to keep the fuzzy search small
+        for name in sorted(self.cities):
+            self.byLetter.setdefault(name[:1], []).append(name)
+
+    #splits "City, CC" into the folded city name and an upper case country code (or None)
+    def split(self, location):
+        location = " ".join(str(location).split())
+        name, comma, country = location.rpartition(",")
+        if comma and len(country.strip()) == 2:
+            return foldName(name), country.strip().upper()
+        return foldName(location), None
+
+    def find(self, location):
+        name, country = self.split(location)
+        for index in (self.cities, self.aliases):
+            for city in index.get(name, []):
+                if country is None or city[1] == country:
+                    return city
+
+    #the closest known city to a misspelled name, if there's a convincing one
+    def suggest(self, location):
+        name, country = self.split(location)
+        if not name or (country is not None and country not in self.countries):
+            return None
+        for candidate in difflib.get_close_matches(name, self.byLetter.get(name[:1], []), n=3, cutoff=LOCATION_MATCH_CUTOFF):
+            for city in self.cities[candidate]:
+                if country is None or city[1] == country:
+                    return city
+
+    #returns the canonical "City,CC" to query OpenWeatherMap with
+    def forecastQuery(self, location):
+        city = self.find(location)
+        if city is not None:
+            return city[0] + "," + city[1]
+        return normalizeLocation(location)
+
+    #same as above, but WAQI only takes a city name
+    def aqiQuery(self, location):
+        city = self.find(location)
+        if city is not None:
+            return city[0]
+        return " ".join(str(location).split())
+
+    #added to "not found" errors from the APIs, so a typo still gets a helpful answer
+    def hint(self, location):
+        city = self.suggest(location) if location is not None and self.find(location) is None else None
+        if city is None:
+            return ""
+        return "\nDid you mean " + city[0] + ", " + city[1] + "?"
+
+gazetteer = Gazetteer(CITIES_FILE)
+
+
+#################################################
+
+############### Caching section #################
+
+
+#A small in-memory cache where every entry carries its own expiry time. Callers asking for something that's already being fetched
+#wait on that same fetch instead of starting another one, so a burst of identical commands only ever costs one upstream request.
+class TTLCache:
+    def __init__(self, name, maxEntries=1000):
+        self.name = name
+        self.maxEntries = maxEntries
+        self.entries = {}   #key -> (expiry timestamp, value). Expired entries stick around so stale data is still available in a pinch.
+        self.inflight = {}  #key -> task currently fetching that key
+
+    def lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > monotonic():
+            return entry[1]
+
+    #returns the value even if it has expired, or None if it was never fetched
+    def stale(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            return entry[1]
+
+    def expiresIn(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return 0
+        return entry[0] - monotonic()
+
+    def store(self, key, value, ttl):
+        self.entries.pop(key, None)
+        self.entries[key] = (monotonic() + ttl, value)
+        while len(self.entries) > self.maxEntries:
+            del self.entries[next(iter(self.entries))] #oldest write goes first
+
+    #fetch is a coroutine function returning (value, seconds to keep it). A ttl of 0 hands the value back without caching it.
+    async def get(self, key, fetch):
+        value = self.lookup(key)
+        if value is not None:
+            metrics.count('cache_requests_total', cache=self.name, result="hit")
+            return value
+        metrics.count('cache_requests_total', cache=self.name, result="miss")
+        try:
+            return await self.refresh(key, fetch)
+        except QuotaExhausted:
+            value = self.stale(key) #out of requests for now, old data beats no data
+            if value is None:
+                raise
+            metrics.count('cache_requests_total', cache=self.name, result="stale")
+            return value
+
+    #fetches the key even if it's still fresh, used to renew entries before they run out
+    async def refresh(self, key, fetch):
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.load(key, fetch))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception()) #nobody might be left waiting on a failed fetch, don't warn about it
+            self.inflight[key] = task
+        return await asyncio.shield(task) #one caller giving up shouldn't cancel the fetch for everyone else
+
+    async def load(self, key, fetch):
+        try:
+            value, ttl = await fetch()
+            if ttl > 0:
+                self.store(key, value, ttl)
+            return value
+        finally:
+            self.inflight.pop(key, None)
+
+#When running as a cluster, raw API responses are also kept in an SQLite table every process can read, so a location fetched by one
+#process is a cache hit for all of them. A single process doesn't need it and skips straight to the API.
+class SharedCache:
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS upstream (key TEXT PRIMARY KEY, expires REAL NOT NULL, payload TEXT NOT NULL)")
+        self.connection.commit()
+        self.saves = 0
+
+    def loadSync(self, key):
+        row = self.connection.execute("SELECT expires, payload FROM upstream WHERE key = ?", (key,)).fetchone()
+        now = datetime.datetime.now(datetime.timezone.utc).timestamp()
+        if row is not None and row[0] > now:
+            return json.loads(row[1]), row[0] - now
+
+    def saveSync(self, key, payload, ttl):
+        now = datetime.datetime.now(datetime.timezone.utc).timestamp()
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO upstream (key, expires, payload) VALUES (?, ?, ?)", (key, now + ttl, payload))
+            self.saves += 1
+            if self.saves % 100 == 0:
+                self.connection.execute("DELETE FROM upstream WHERE expires < ?", (now,))
+
+    async def load(self, key):
+        return await asyncio.get_event_loop().run_in_executor(None, self.loadSync, key)
+
+    async def save(self, key, payload, ttl):
+        await asyncio.get_event_loop().run_in_executor(None, self.saveSync, key, json.dumps(payload), ttl)
+
+    async def close(self):
+        self.connection.close()
+
+sharedCache = None
+if ShardIDs is not None:
+    sharedCache = SharedCache(CacheDatabase)
+    shutdownHooks.append(sharedCache.close)
+
+#gets a raw API response, from the shared cache if another process already has it. ttlFor decides how long a response stays good.
+async def sharedFetch(key, fetchRaw, ttlFor):
+    if sharedCache is not None:
+        found = await sharedCache.load(key)
+        if found is not None:
+            return found
+    payload = await fetchRaw()
+    ttl = ttlFor(payload)
+    if sharedCache is not None and ttl > 0:
+        await sharedCache.save(key, payload, ttl)
+    return payload, ttl
+
+#OpenWeatherMap icon codes mapped to the closest Discord emoji
+WEATHER_EMOJI = {
+    "01d": ":sunny:",                   # Clear Day
+    "01n": ":new_moon:",                # Clear Night
+    "02d": ":white_sun_small_cloud:",   # few clouds
+    "02n": ":white_sun_small_cloud:",
+    "03d": ":white_sun_cloud:",         # scattered clouds
+    "03n": ":white_sun_cloud:",
+    "04d": ":cloud:",                   # overcast
+    "04n": ":cloud:",
+    "09d": ":cloud_rain:",              # showers
+    "09n": ":cloud_rain:",
+    "10d": ":white_sun_rain_cloud:",    # rain
+    "10n": ":white_sun_rain_cloud:",
+    "11d": ":thunder_cloud_rain:",      # thunder
+    "11n": ":thunder_cloud_rain:",
+    "13d": ":cloud_snow:",              # snow
+    "13n": ":cloud_snow:",
+    "50d": ":fog:",                     # fog
+    "50n": ":fog:",
+}
+UNKNOWN_WEATHER_EMOJI = ":face_with_symbols_over_mouth:"
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+EPOCH = datetime.datetime(1970, 1, 1)
+
+#Gets the temperature and converts it from Kelvin to Celsius
+def celsius(kelvin):
+    return round(int(kelvin) - 273.15, 2)
+
+#One 3 hour step of a forecast, with the time already shifted into the location's local time
+class ForecastEntry:
+    __slots__ = ('time', 'weekday', 'description', 'icon', 'emoji', 'temp', 'feelsLike')
+
+    def __init__(self, d, timezone):
+        self.time = EPOCH + datetime.timedelta(seconds=d['dt'] + timezone)
+        self.weekday = WEEKDAYS[self.time.weekday()]
+        self.description = str(d['weather'][0]['description'])
+        self.icon = str(d['weather'][0]['icon'])
+        self.emoji = WEATHER_EMOJI.get(self.icon, UNKNOWN_WEATHER_EMOJI)
+        self.temp = celsius(d['main']['temp'])
+        self.feelsLike = celsius(d['main']['feels_like'])
+
+#A forecast response parsed once into entries, with an index of entries per local weekday. Error responses keep only their code and message.
+class Forecast:
+    __slots__ = ('cod', 'message', 'city', 'country', 'timezone', 'lat', 'lon', 'entries', 'days', 'middays')
+
+    def __init__(self, payload):
+        self.cod = str(payload['cod'])
+        self.message = payload.get('message')
+        self.entries = []
+        self.days = {}      #weekday name -> that day's entries, in order
+        self.middays = []   #the entry closest to noon on each day
+        if self.cod != "200":
+            return
+        self.city = str(payload['city']['name'])
+        self.country = str(payload['city']['country'])
+        self.timezone = payload['city']['timezone']
+        self.lat = payload['city'].get('coord', {}).get('lat')
+        self.lon = payload['city'].get('coord', {}).get('lon')
+        for d in payload['list']:
+            entry = ForecastEntry(d, self.timezone)
+            self.entries.append(entry)
+            self.days.setdefault(entry.weekday, []).append(entry)
+            if 11 <= entry.time.hour <= 13:
+                self.middays.append(entry)
+
+    def ok(self):
+        return self.cod == "200"
+
+    def today(self):
+        return WEEKDAYS[(datetime.datetime.utcnow() + datetime.timedelta(seconds=self.timezone)).weekday()]
+
+    #the first entry, followed by the midday entry of each day after it
+    def daily(self, count):
+        picks = self.entries[:1] + [e for e in self.middays if e is not self.entries[0]]
+        return picks[:count]
+
+#OpenWeatherMap publishes its forecast in 3 hour steps, so a fetched forecast is good until the next step (plus a little leeway so the warmer has time to renew it)
+FORECAST_STEP = 3 * 3600
+FORECAST_PUBLISH_DELAY = 900
+FORECAST_ERROR_TTL = 600    #how long to remember that a location doesn't exist
+forecastCache = TTLCache('forecast')
+
+#AQI stations report hourly, so half an hour is plenty fresh
+AQI_TTL = 1800
+aqiCache = TTLCache('aqi')
+
+#how many seconds until the forecast fetched right now goes out of date
+def forecastTTL():
+    epoch = datetime.datetime.now(datetime.timezone.utc).timestamp()
+    return (math.floor(epoch / FORECAST_STEP) + 1) * FORECAST_STEP + FORECAST_PUBLISH_DELAY - epoch
+
+#extra spaces and capitals don't change what the API returns, so "Victoria , CA" and "victoria,ca" share a cache entry
+def normalizeLocation(location):
+    return re.sub(r"\s*,\s*", ",", " ".join(str(location).split())).lower()
+
+def forecastPayloadTTL(payload):
+    if str(payload.get('cod')) == "200":
+        return forecastTTL()
+    if str(payload.get('cod')) == "404":
+        return FORECAST_ERROR_TTL
+    return 0 #rate limits and the like clear up on their own, don't hold onto them
+
+def forecastFetcher(query, priority=PRIORITY_INTERACTIVE):
+    async def fetch():
+        payload, ttl = await sharedFetch('forecast:' + query.lower(), lambda: httpGet(WEATHER_URL, params={'q': query, 'appid': WeatherToken}, quota='weather', priority=priority), forecastPayloadTTL)
+        return Forecast(payload), ttl
+    return fetch
+
+def aqiPayloadTTL(payload):
+    if payload.get("status") == "ok":
+        return AQI_TTL
+    if payload.get("data") == "Unknown station":
+        return FORECAST_ERROR_TTL
+    return 0
+
+def aqiFetcher(query, priority=PRIORITY_INTERACTIVE):
+    async def fetch():
+        return await sharedFetch('aqi:' + query.lower(), lambda: httpGet(AQI_URL + urllib.parse.quote(query) + "/", params={'token': AQIToken}, quota='aqi', priority=priority), aqiPayloadTTL)
+    return fetch
+
+metrics.gauge('cache_entries', lambda: {(('cache', cache.name),): len(cache.entries) for cache in (forecastCache, aqiCache, leaderboardCache)}, "Entries held by each cache, expired ones included.")
+
+#gets the parsed 5 day forecast for a location, shared by the time, temperature and forecast commands
+async def getForecast(location):
+    query = gazetteer.forecastQuery(location)
+    return await forecastCache.get(query.lower(), forecastFetcher(query))
+
+#gets the air quality readings for a location, shared by both AQI commands
+async def getAQI(location):
+    query = gazetteer.aqiQuery(location)
+    return await aqiCache.get(query.lower(), aqiFetcher(query))
+
+#A server's whole Mee6 leaderboard, fetched in big pages and indexed by user ID
+MEE6_PAGE_SIZE = 1000
+MEE6_PAGE_LIMIT = 5         #pages to fetch at most, so the biggest servers don't turn into dozens of requests
+MEE6_TTL = 300              #seconds before a leaderboard is refreshed
+MEE6_MISSING_STATUSES = (401, 403, 404) #the server has no leaderboard, or it's private. Anything else is worth retrying straight away.
+leaderboardCache = TTLCache('leaderboard')
+
+class Leaderboard:
+    __slots__ = ('error', 'players', 'ranking')
+
+    def __init__(self, pages=(), error=None):
+        self.error = error
+        self.players = {}   #user ID -> (rank, level, xp, username)
+        self.ranking = []   #user IDs, best first
+        for page in pages:
+            for player in page['players']:
+                userID = int(player['id'])
+                self.ranking.append(userID)
+                self.players[userID] = (len(self.ranking), int(player['level']), int(player['xp']), player.get('username'))
+
+#Only a missing leaderboard is remembered. Rate limits, outages and a page failing part way through aren't cached at all, so a failed
+#background refresh leaves the last good leaderboard in place.
+def leaderboardPayloadTTL(payload):
+    if 'pages' in payload:
+        return MEE6_TTL
+    if payload.get('missing'):
+        return FORECAST_ERROR_TTL
+    return 0
+
+def leaderboardFetcher(guildID, priority=PRIORITY_INTERACTIVE):
+    async def fetchPages():
+        pages = []
+        for page in range(MEE6_PAGE_LIMIT):
+            status, response = await httpGetWithStatus(MEE6_URL + str(guildID), params={'page': page, 'limit': MEE6_PAGE_SIZE}, quota='mee6', priority=priority)
+            if not isinstance(response, dict) or 'players' not in response:
+                error = response.get('error', {}) if isinstance(response, dict) else {}
+                return {'error': error, 'missing': page == 0 and status in MEE6_MISSING_STATUSES}
+            pages.append(response)
+            if len(response['players']) < MEE6_PAGE_SIZE:
+                break
+        return {'pages': pages}
+
+    async def fetch():
+        payload, ttl = await sharedFetch('mee6:' + str(guildID), fetchPages, leaderboardPayloadTTL)
+        if 'pages' in payload:
+            return Leaderboard(payload['pages']), ttl
+        error = payload['error']
+        return Leaderboard(error=error.get('message', "This server's Mee6 leaderboard isn't available.") if isinstance(error, dict) else str(error)), ttl
+    return fetch
+
+#an expired leaderboard is still handed back straight away while a fresh copy is fetched in the background
+async def getLeaderboard(guildID):
+    board = leaderboardCache.lookup(guildID)
+    if board is not None:
+        metrics.count('cache_requests_total', cache=leaderboardCache.name, result="hit")
+        return board
+    board = leaderboardCache.stale(guildID)
+    if board is not None:
+        metrics.count('cache_requests_total', cache=leaderboardCache.name, result="stale")
+        if guildID not in leaderboardCache.inflight:
+            asyncio.ensure_future(leaderboardCache.refresh(guildID, leaderboardFetcher(guildID, PRIORITY_BACKGROUND))).add_done_callback(lambda t: t.cancelled() or t.exception())
+        return board
+    return await leaderboardCache.get(guildID, leaderboardFetcher(guildID))
+
+#Most commands are used without a location, so every server's default locations are known ahead of time. This keeps them
+#renewed in the background before they expire, spacing the requests out so the warmer never eats through the API quota.
+#Only locations that were last fetched successfully are kept warm: a misspelled default would otherwise cost a request every sweep.
+WARM_CHECK_INTERVAL = 60    #seconds between sweeps for entries that are about to expire
+WARM_MARGIN = 600           #renew entries that expire within this many seconds
+WARM_SPACING = 2            #seconds between two background requests
+
+async def weatherWarmer():
+    while True:
+        due = []
+        for cache, makeQuery, fetcher, defaultType, succeeded in ((forecastCache, gazetteer.forecastQuery, forecastFetcher, 'defaultCity', lambda forecast: forecast.ok()),
+                                                                  (aqiCache, gazetteer.aqiQuery, aqiFetcher, 'AQI_defaultCity', lambda aqi: aqi.get("status") == "ok")):
+            queries = set()
+            for d in settings.servers.values():
+                if not ownsGuild(d['serverID']):
+                    continue
+                queries.add(makeQuery(d[defaultType]))
+            for query in queries:
+                last = cache.stale(query.lower())
+                if last is not None and succeeded(last) and cache.expiresIn(query.lower()) < WARM_MARGIN:
+                    due.append((cache, query.lower(), fetcher(query, PRIORITY_BACKGROUND)))
+        for cache, key, fetch in due:
+            try:
+                await cache.refresh(key, fetch)
+            except UpstreamError:
+                pass #it'll be picked up again next sweep
+            await asyncio.sleep(WARM_SPACING)
+        await asyncio.sleep(WARM_CHECK_INTERVAL)
+
+
+#################################################
+
+############### Settings section ################
+
+
+#Every server's defaults are held in memory, keyed by server ID. Changes are batched up and written back to the storage backend in the background.
+SETTINGS_FILE = 'Resident-Clock-Defaults.json'
+SETTINGS_FLUSH_DELAY = 5    #seconds to wait after a change so that a burst of changes only costs one write
+GUILD_RETENTION = 30 * 86400    #seconds a server's settings are kept after the bot leaves it, in case it gets invited back
+
+#Each step brings a server's defaults up to the next schema version. This is done for future-proofing, to make sure that all new bot
+#commands have their required default values consistently added. To add a new default, add a step here and the store handles the rest.
+def migrateBaseDefaults(d):
+    d.setdefault("defaultCity", "Victoria, CA")
+    d.setdefault("AQI_defaultCity", "Victoria")
+    d.setdefault("Timezone", 0)
+    d.setdefault("ClockChannel", None)
+
+SETTINGS_MIGRATIONS = [
+    (1, migrateBaseDefaults),
+]
+SETTINGS_SCHEMA_VERSION = SETTINGS_MIGRATIONS[-1][0]
+
+#runs every step the entry hasn't seen yet, returns True if anything had to be done
+def migrateEntry(d):
+    version = d.get('schemaVersion', 0)
+    if version >= SETTINGS_SCHEMA_VERSION:
+        return False
+    for stepVersion, step in SETTINGS_MIGRATIONS:
+        if stepVersion > version:
+            step(d)
+    d['schemaVersion'] = SETTINGS_SCHEMA_VERSION
+    return True
+
+#a brand new server's defaults, built by the same migration steps so the two can never drift apart
+def newServerDefaults(serverID):
+    d = {'serverID': serverID}
+    migrateEntry(d)
+    return d
+
+#write to a temporary file first and swap it in, so a crash mid-write never leaves a half-written file behind
+def writeAtomic(path, text):
+    temp = path + '.tmp'
+    with open(temp, 'w') as outfile:
+        outfile.write(text)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(temp, path)
+
+#Stores every server in one JSON file. Simple and easy to hand-edit, but every save rewrites the whole file.
+class JsonSettingsBackend:
+    fullRewrite = True
+
+    def __init__(self, path):
+        self.path = path
+
+    def loadAll(self):
+        with open(self.path) as json_file:
+            data = json.load(json_file)
+        return data['per_server']
+
+    def save(self, changed, everything):
+        writeAtomic(self.path, everything)
+
+    def close(self):
+        pass
+
+#Stores one row per server in an SQLite database running in WAL mode, so saving a change to one server only touches that server's row
+class SqliteSettingsBackend:
+    fullRewrite = False
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS servers (serverID INTEGER PRIMARY KEY, settings TEXT NOT NULL)")
+        self.connection.commit()
+
+    def loadAll(self):
+        return [json.loads(row[0]) for row in self.connection.execute("SELECT settings FROM servers")]
+
+    #changed maps server IDs to their settings, or to None for servers that should be deleted
+    def save(self, changed, everything):
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO servers (serverID, settings) VALUES (?, ?)", [(serverID, text) for serverID, text in changed.items() if text is not None])
+            self.connection.executemany("DELETE FROM servers WHERE serverID = ?", [(serverID,) for serverID, text in changed.items() if text is None])
+
+    #one-shot import of an existing defaults file, only done while the database is still empty so it never clobbers newer data
+    def importJson(self, path):
+        if self.connection.execute("SELECT COUNT(*) FROM servers").fetchone()[0] > 0 or not os.path.exists(path):
+            return 0
+        rows = {}
+        for d in JsonSettingsBackend(path).loadAll():
+            if 'serverID' in d:
+                rows.setdefault(int(d['serverID']), json.dumps(d)) #the first entry for a server is the one that was always read
+        self.save(rows, None)
+        print("imported " + str(len(rows)) + " servers from " + path)
+        return len(rows)
+
+    def close(self):
+        self.connection.close()
+
+#Servers the bot has left are moved out of the working set into `departed` with the time they left, so nothing that walks every
+#server (the clocktower, the weather warmer) spends time on them. Their settings come back if the bot is invited again, and
+#they're deleted for good once they've been gone for GUILD_RETENTION.
+class SettingsStore:
+    def __init__(self, backend):
+        self.backend = backend
+        self.servers = {}
+        self.departed = {}
+        self.dirtyIDs = set()
+        self.flushTask = None
+        self.flushWaiting = False   #whether flushTask is still waiting out its delay, rather than writing
+        self.writeLock = None
+        self.load()
+
+    #Out of date entries are migrated in memory and saved in a single write, rather than rewriting the file once per server.
+    #Older versions of the bot added a new entry every time it was invited back, the first one is the one that was always read so it's kept.
+    def load(self):
+        repaired = set()
+        duplicates = 0
+        for d in self.backend.loadAll():
+            if 'serverID' not in d:
+                continue
+            serverID = int(d['serverID'])
+            if serverID in self.servers or serverID in self.departed:
+                duplicates += 1
+                repaired.add(serverID)
+                continue
+            migrated = migrateEntry(d)
+            if d['serverID'] != serverID or migrated:
+                d['serverID'] = serverID
+                repaired.add(serverID)
+            if d.get('departedAt') is not None:
+                self.departed[serverID] = d
+            else:
+                self.servers[serverID] = d
+        if repaired:
+            self.backend.save(*self.snapshot(repaired))
+            print("repaired " + str(len(repaired)) + " servers (" + str(duplicates) + " duplicates removed), settings schema version " + str(SETTINGS_SCHEMA_VERSION))
+
+    def snapshot(self, serverIDs):
+        changed = {}
+        for serverID in serverIDs:
+            entry = self.servers.get(serverID) or self.departed.get(serverID)
+            changed[serverID] = json.dumps(entry) if entry is not None else None
+        everything = None
+        if self.backend.fullRewrite:
+            everything = json.dumps({'per_server': list(self.servers.values()) + list(self.departed.values())})
+        return changed, everything
+
+    def entry(self, serverID):
+        return self.servers.get(serverID)
+
+    def get(self, serverID, defaultType):
+        entry = self.servers.get(serverID)
+        if entry is not None:
+            return entry[defaultType]
+
+    def add(self, entry):
+        self.servers[entry['serverID']] = entry
+        self.markDirty(entry['serverID'])
+
+    def update(self, serverID, changes):
+        self.servers.setdefault(serverID, {'serverID': serverID}).update(changes)
+        self.markDirty(serverID)
+
+    #called when the bot joins a server. A server it left earlier gets its old settings back, otherwise it starts from the defaults.
+    def join(self, serverID):
+        entry = self.departed.pop(serverID, None)
+        if entry is not None:
+            entry.pop('departedAt', None)
+            self.servers[serverID] = entry
+            self.markDirty(serverID)
+        elif serverID not in self.servers:
+            self.add(newServerDefaults(serverID))
+        return self.servers[serverID]
+
+    def leave(self, serverID):
+        entry = self.servers.pop(serverID, None)
+        if entry is not None:
+            entry['departedAt'] = datetime.datetime.now(datetime.timezone.utc).timestamp()
+            self.departed[serverID] = entry
+            self.markDirty(serverID)
+        return entry
+
+    #deletes servers that have been gone longer than GUILD_RETENTION
+    #In cluster mode the other processes' departed servers may be out of date here (they could have been invited back since), so only
+    #this process's own shards are ever deleted.
+    def compact(self):
+        cutoff = datetime.datetime.now(datetime.timezone.utc).timestamp() - GUILD_RETENTION
+        expired = [serverID for serverID, entry in self.departed.items() if entry['departedAt'] < cutoff and ownsGuild(serverID)]
+        for serverID in expired:
+            del self.departed[serverID]
+            self.markDirty(serverID)
+        return len(expired)
+
+    #Matches the stored servers against the ones the bot is actually in, catching any joins and removals missed while it was offline.
+    #In cluster mode only the servers on this process's shards are looked at, the other processes take care of theirs.
+    def reconcile(self, guildIDs):
+        guildIDs = set(guildIDs)
+        joined = [serverID for serverID in guildIDs if serverID not in self.servers]
+        left = [serverID for serverID in self.servers if serverID not in guildIDs and ownsGuild(serverID)]
+        for serverID in joined:
+            self.join(serverID)
+        for serverID in left:
+            self.leave(serverID)
+        compacted = self.compact()
+        if joined or left or compacted:
+            print("reconciled servers: " + str(len(joined)) + " joined, " + str(len(left)) + " left, " + str(compacted) + " deleted after " + str(GUILD_RETENTION // 86400) + " days")
+
+    #schedules a write a few seconds out, any other changes made in the meantime ride along with it
+    def markDirty(self, serverID):
+        self.dirtyIDs.add(serverID)
+        if self.flushTask is None or self.flushTask.done():
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return #no event loop yet, the change will be written by the next flush
+            self.flushWaiting = True
+            self.flushTask = loop.create_task(self.delayedFlush())
+
+    async def delayedFlush(self):
+        await asyncio.sleep(SETTINGS_FLUSH_DELAY)
+        self.flushWaiting = False
+        await self.flush()
+
+    #the snapshot is taken on the event loop so it's always consistent, then written off-loop. The lock keeps an older snapshot from landing after a newer one.
+    async def flush(self):
+        if self.writeLock is None:
+            self.writeLock = asyncio.Lock()
+        async with self.writeLock:
+            if not self.dirtyIDs:
+                return
+            dirtyIDs, self.dirtyIDs = self.dirtyIDs, set()
+            changed, everything = self.snapshot(dirtyIDs)
+            try:
+                await asyncio.get_event_loop().run_in_executor(None, self.backend.save, changed, everything)
+            except Exception:
+                self.dirtyIDs |= dirtyIDs
+                raise
+
+    #A flush that's still waiting is cancelled, one that's already writing is waited for, so the backend is never closed under it
+    async def close(self):
+        if self.flushTask is not None and not self.flushTask.done():
+            if self.flushWaiting:
+                self.flushTask.cancel()
+            await asyncio.gather(self.flushTask, return_exceptions=True)
+        await self.flush()
+        self.backend.close()
+
+#picks the storage backend set in the config file, the JSON file is used if nothing is set
+def makeSettingsBackend():
+    if SettingsBackend == "sqlite":
+        backend = SqliteSettingsBackend(SettingsDatabase)
+        backend.importJson(SETTINGS_FILE)
+        return backend
+    return JsonSettingsBackend(SETTINGS_FILE)
+
+settings = SettingsStore(makeSettingsBackend())
+shutdownHooks.append(settings.close)
+metrics.gauge('servers', lambda: {(('state', "active"),): len(settings.servers), (('state', "departed"),): len(settings.departed)}, "Servers with stored settings, by whether the bot is still in them.")
+
+#Heroku stops the bot with SIGTERM, so make sure that runs through the regular shutdown and pending settings get saved
+def installSignalHandlers():
+    loop = asyncio.get_event_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, lambda: asyncio.ensure_future(bot.close()))
+        except (NotImplementedError, RuntimeError):
+            pass #not supported on Windows
+
+
 #################################################
 
 ############### Functions section ###############
@@ -113,71 +1275,588 @@ async def on_guild_join(guild):
 
 # used to snag a default-value for each server.
 def defaultGet(defaultType: str, serverID: str):
-    with open('Resident-Clock-Defaults.json') as json_file:
-        data = json.load(json_file)
-        list = data['per_server']
-        for d in list:
-            if serverID == d['serverID']:
-                return d[defaultType]
+    return settings.get(serverID, defaultType)
 
 # clocktower provides a service to make a channel update its name as a "clock" of sorts. Has timezone support. Each server can have a max of one of these channels.
+CLOCK_INTERVAL = 300    #seconds between clock updates, every tick lands on a wall-clock boundary of this size
+
+#the next wall-clock boundary strictly after the given time, e.g. 12:05:00 for anything from 12:00:00 up to 12:04:59
+def nextClockTick(now):
+    epoch = now.timestamp()
+    return datetime.datetime.fromtimestamp((math.floor(epoch / CLOCK_INTERVAL) + 1) * CLOCK_INTERVAL, datetime.timezone.utc)
+
+#sleeps until exactly the next boundary, then queues an update for every configured clock channel for that tick
 async def clocktower():
     while True:
-        now = datetime.datetime.utcnow()
-        if (now.minute%5 == 0) and now.second >= 0 and now.second <= 1: #only print at the start of every 5 minute interval
-            with open('Resident-Clock-Defaults.json') as json_file:
-                data = json.load(json_file)
-            for x in data['per_server']:
-                if x['ClockChannel'] is not None: #only attempt to write to a server's channels if a channel is selected
-                    channel = bot.get_channel(x['ClockChannel']) #get the channel to write to
-                    now += datetime.timedelta(hours=int(x["Timezone"])) #get the time
-                    await channel.edit(name=now.strftime("Time: %-I:%M %p, %a (") + timezoneget(int(x["Timezone"])*3600) + ")") #edits the selected channel's name to get a printout of the time
-                    await asyncio.sleep(299) # only run the command once every 5 minutes after a successful channel name change
-        await asyncio.sleep(1) # keep pinging every second until we get a successful time change. A bit impractical, but necesarry for accurate time.
-
-#used to efficiently grab the name of a timezone based on an hour offset
-def timezoneget(offset):
-    houradjusted = int(offset)/3600
-    return {
-        -12: "IDLW",
-        -11: "NT",
-        -10: "HST",
-        -9: "AKST",
-        -8: "PST",
-        -7: "MST",
-        -6: "CST",
-        -5: "EST",
-        -4: "AST",
-        -3: "ART",
-        -2: "AT",
-        -1: "WAT",
-        0: "GMT",
-        1: "CET",
-        2: "EET",
-        3: "MSK",
-        4: "AMT",
-        5: "PKT",
-        6: "OMSK",
-        7: "KRAT",
-        8: "CST",
-        9: "JST",
-        10: "AEST",
-        11: "SAKT",
-        12: "NZST",
-    }[int(houradjusted)]
-
-#calculates moon position based on the date
-def moonpos(dec, now=None):
-
-   if now is None:
-      now = datetime.datetime.now()
-
-   diff = now - datetime.datetime(2001, 1, 1)
-   days = dec(diff.days) + (dec(diff.seconds) / dec(86400))
-   lunations = dec("0.20439731") + (days * dec("0.03386319269"))
-
-   return lunations % dec(1)
+        tick = nextClockTick(datetime.datetime.now(datetime.timezone.utc))
+        now = datetime.datetime.now(datetime.timezone.utc)
+        while now < tick: #sleep can wake up a hair early, so top it up until the boundary has actually passed
+            await asyncio.sleep((tick - now).total_seconds())
+            now = datetime.datetime.now(datetime.timezone.utc)
+        drift = (now - tick).total_seconds()
+        metrics.observe('clock_tick_drift_seconds', drift)
+        started = monotonic()
+
+        towers = [x for x in settings.servers.values() if x['ClockChannel'] is not None and ownsGuild(x['serverID'])] #only attempt to write to a server's channels if a channel is selected
+        for x in towers:
+            try:
+                channelID = int(x['ClockChannel'])
+            except ValueError:
+                continue
+            clockEdits.submit(x['serverID'], channelID, clockName(tick, x["Timezone"]))
+        metrics.observe('clock_tick_seconds', monotonic() - started)
+        print("clocktower tick " + tick.strftime("%H:%M") + " UTC: " + str(len(towers)) + " channels queued, " + str(clockEdits.depth()) + " edits pending, drift " + str(round(drift, 3)) + "s")
+
+#the channel name for a tick in the given timezone
+def clockName(tick, offset):
+    now = tick.astimezone(getTz(offset) or datetime.timezone.utc) #get the time
+    return now.strftime("Time: %-I:%M %p, %a (") + timezoneLabel(now) + ")"
+
+#Discord only allows two renames per channel every ten minutes, so every clock channel edit goes through this queue rather than straight to Discord.
+#Each channel has its own bucket on top of one shared bucket for the whole route, and a channel only ever has one edit waiting; newer names replace older ones.
+CLOCK_CHANNEL_LIMIT = (2, 600)  #renames allowed per channel, per seconds
+CLOCK_ROUTE_LIMIT = (5, 1)      #renames allowed across every channel, per seconds
+CLOCK_QUEUE_SIZE = 10000        #channels waiting on an edit before new ones get dropped until the next tick
+CLOCK_WORKERS = 4
+CLOCK_MAX_RETRIES = 4
+
+class ChannelEditQueue:
+    def __init__(self):
+        self.queue = None
+        self.workers = []
+        self.desired = {}       #channel ID -> (server ID, name) still to be applied
+        self.applied = {}       #channel ID -> last name that made it to Discord
+        self.buckets = {}
+        self.routeBucket = TokenBucket(*CLOCK_ROUTE_LIMIT)
+        self.attempts = {}
+        self.dropped = 0
+
+    def start(self):
+        if self.queue is None:
+            self.queue = asyncio.Queue(maxsize=CLOCK_QUEUE_SIZE)
+            self.workers = [asyncio.ensure_future(self.worker()) for i in range(CLOCK_WORKERS)]
+
+    def depth(self):
+        return len(self.desired)
+
+    def submit(self, serverID, channelID, name):
+        if self.applied.get(channelID) == name:
+            return #nothing would change, don't spend a rename on it
+        waiting = channelID in self.desired
+        self.desired[channelID] = (serverID, name)
+        if not waiting: #a channel that's already waiting just picks up the newer name
+            self.start()
+            self.enqueue(channelID)
+
+    def enqueue(self, channelID):
+        try:
+            self.queue.put_nowait(channelID)
+        except asyncio.QueueFull:
+            self.desired.pop(channelID, None)
+            self.dropped += 1
+
+    def retryLater(self, channelID, delay):
+        asyncio.get_event_loop().call_later(delay, self.enqueue, channelID)
+
+    async def worker(self):
+        while True:
+            channelID = await self.queue.get()
+            try:
+                await self.process(channelID)
+            except Exception as e:
+                print("clock channel " + str(channelID) + " edit failed: " + repr(e))
+            finally:
+                self.queue.task_done()
+
+    async def process(self, channelID):
+        if channelID not in self.desired:
+            return
+        serverID, name = self.desired[channelID]
+        channel = bot.get_channel(channelID)
+        if channel is None:
+            channel = await self.lookup(serverID, channelID)
+            if channel is None:
+                return
+        if channel.name == name:
+            self.applied[channelID] = self.desired.pop(channelID)[1]
+            return
 
+        bucket = self.buckets.setdefault(channelID, TokenBucket(*CLOCK_CHANNEL_LIMIT))
+        if not bucket.take():
+            self.retryLater(channelID, bucket.waitTime())
+            return
+        while not self.routeBucket.take():
+            await asyncio.sleep(self.routeBucket.waitTime())
+
+        serverID, name = self.desired.pop(channelID) #the newest name, in case it changed while waiting on the route
+        started = monotonic()
+        try:
+            await channel.edit(name=name)
+        except (discord.NotFound, discord.Forbidden):
+            metrics.count('clock_edit_errors_total', reason="gone")
+            self.disable(serverID, channelID, "the channel is gone or can't be edited")
+            return
+        except discord.HTTPException as e:
+            metrics.count('clock_edit_errors_total', reason=str(e.status))
+            attempts = self.attempts.get(channelID, 0) + 1
+            if attempts > CLOCK_MAX_RETRIES:
+                print("clock channel " + str(channelID) + " gave up after " + str(CLOCK_MAX_RETRIES) + " retries: " + repr(e))
+                self.attempts.pop(channelID, None)
+                return
+            self.attempts[channelID] = attempts
+            self.desired.setdefault(channelID, (serverID, name))
+            self.retryLater(channelID, (2 ** attempts) + random.uniform(0, 2 ** attempts)) #jitter so retries don't all land at once
+            return
+        finally:
+            metrics.observe('clock_edit_seconds', monotonic() - started)
+        self.applied[channelID] = name
+        self.attempts.pop(channelID, None)
+
+    #A channel missing from the cache hasn't necessarily been deleted: discord.py empties its cache on every reconnect, and servers stay
+    #unavailable (with no channels cached) until Discord sends them again or during an outage. Those edits are skipped and the next tick
+    #tries again. Only Discord itself saying the channel is gone or off limits turns the clocktower off.
+    async def lookup(self, serverID, channelID):
+        guild = bot.get_guild(int(serverID))
+        if not bot.is_ready() or guild is None or guild.unavailable:
+            self.desired.pop(channelID, None)
+            return None
+        try:
+            return await bot.fetch_channel(channelID)
+        except (discord.NotFound, discord.Forbidden):
+            self.disable(serverID, channelID, "the channel no longer exists")
+        except discord.HTTPException:
+            self.desired.pop(channelID, None)
+        return None
+
+    #turns off a server's clocktower so it isn't retried every tick forever
+    def disable(self, serverID, channelID, reason):
+        print("disabling clock channel " + str(channelID) + " for server " + str(serverID) + ": " + reason)
+        self.forget(channelID)
+        entry = settings.entry(serverID)
+        if entry is not None and str(entry['ClockChannel']) == str(channelID):
+            settings.update(serverID, {'ClockChannel': None})
+
+    #drops everything queued or remembered for a channel, a queued edit for it is skipped when it comes up
+    def forget(self, channelID):
+        for state in (self.desired, self.applied, self.buckets, self.attempts):
+            state.pop(channelID, None)
+
+    async def close(self):
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True) #an edit in progress may still disable a channel, let it land first
+
+clockEdits = ChannelEditQueue()
+shutdownHooks.append(clockEdits.close)
+metrics.gauge('clock_edits_pending', lambda: {(): clockEdits.depth()}, "Clock channels waiting on a rename.")
+metrics.gauge('clock_edits_dropped', lambda: {(): clockEdits.dropped}, "Clock channel renames dropped because the queue was full.")
+
+#Every long-running loop is registered here under a name and started once per process. on_ready fires again on every reconnect and
+#resume, so starting is a no-op for anything already running. A loop that crashes is logged and restarted after a delay that doubles
+#with each crash in a row, and the owner can see how every loop is doing with "!tasks".
+TASK_RESTART_DELAY = 5          #seconds before the first restart
+TASK_RESTART_DELAY_MAX = 300
+TASK_STABLE_AFTER = 600         #a loop that ran this long before crashing is restarted with the shortest delay again
+
+class TaskSupervisor:
+    def __init__(self):
+        self.loops = {}         #name -> coroutine function
+        self.tasks = {}         #name -> the supervising task
+        self.state = {}         #name -> [status, restarts, last error, started at]
+
+    def register(self, name, loopFunction):
+        self.loops[name] = loopFunction
+        self.state[name] = ["stopped", 0, None, None]
+
+    def start(self):
+        for name in self.loops:
+            task = self.tasks.get(name)
+            if task is None or task.done():
+                self.tasks[name] = asyncio.ensure_future(self.supervise(name))
+
+    async def supervise(self, name):
+        state = self.state[name]
+        delay = TASK_RESTART_DELAY
+        while True:
+            state[0] = "running"
+            state[3] = monotonic()
+            try:
+                await self.loops[name]()
+                state[0] = "finished"
+                return
+            except asyncio.CancelledError:
+                state[0] = "stopped"
+                raise
+            except Exception as e:
+                if monotonic() - state[3] > TASK_STABLE_AFTER:
+                    delay = TASK_RESTART_DELAY
+                state[0] = "restarting"
+                state[1] += 1
+                state[2] = repr(e)
+                metrics.count('task_restarts_total', task=name)
+                print("background task " + name + " crashed, restarting in " + str(delay) + "s: " + repr(e))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, TASK_RESTART_DELAY_MAX)
+
+    #(name, status, restarts, last error, seconds since it last started) for every registered loop
+    def status(self):
+        now = monotonic()
+        return [(name, state[0], state[1], state[2], (now - state[3]) if state[3] is not None else None) for name, state in self.state.items()]
+
+    async def stop(self):
+        tasks = [task for task in self.tasks.values() if not task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+supervisor = TaskSupervisor()
+supervisor.register('clocktower', clocktower)
+supervisor.register('weatherWarmer', weatherWarmer)
+shutdownHooks.append(supervisor.stop)
+metrics.describe('task_restarts_total', "Times each background task crashed and was restarted.")
+
+#The owner's view of every server the bot is in (on this process's shards, in cluster mode). Servers are indexed by ID and by
+#lower-cased name and kept current by the join, leave and rename events, so looking one up never walks the whole list.
+FLEET_PAGE_SIZE = 25
+FLEET_NAME_LENGTH = 60      #longer server names get cut off in the list
+
+class GuildIndex:
+    def __init__(self):
+        self.byID = {}
+        self.byName = {}    #lower-cased name -> set of server IDs, names aren't unique
+
+    def rebuild(self, guilds):
+        self.byID = {}
+        self.byName = {}
+        for guild in guilds:
+            self.add(guild)
+
+    def add(self, guild):
+        self.byID[guild.id] = guild
+        self.byName.setdefault(str(guild.name).lower(), set()).add(guild.id)
+
+    def remove(self, guild):
+        self.byID.pop(guild.id, None)
+        ids = self.byName.get(str(guild.name).lower())
+        if ids is not None:
+            ids.discard(guild.id)
+            if not ids:
+                del self.byName[str(guild.name).lower()]
+
+    #every server matching an ID or a name
+    def find(self, query):
+        query = str(query).strip()
+        if query.isdigit() and int(query) in self.byID:
+            return [self.byID[int(query)]]
+        return sorted((self.byID[serverID] for serverID in self.byName.get(query.lower(), ())), key=lambda guild: guild.id)
+
+    #the servers matching the filters, in order. sort is "name", "members" (biggest first) or "joined" (newest first)
+    def select(self, sort="name", minMembers=0, clockOnly=False):
+        guilds = self.byID.values()
+        if minMembers:
+            guilds = [guild for guild in guilds if (guild.member_count or 0) >= minMembers]
+        if clockOnly:
+            guilds = [guild for guild in guilds if settings.get(guild.id, 'ClockChannel') is not None]
+        if sort == "members":
+            return sorted(guilds, key=lambda guild: -(guild.member_count or 0))
+        if sort == "joined":
+            return sorted(guilds, key=lambda guild: joinedAt(guild), reverse=True)
+        return sorted(guilds, key=lambda guild: str(guild.name).lower())
+
+#when the bot joined a server. The bot's own member can be missing from the cache, then the server's creation time is the best guess there is.
+def joinedAt(guild):
+    if guild.me is not None and guild.me.joined_at is not None:
+        return guild.me.joined_at
+    return guild.created_at
+
+def fleetLine(guild):
+    name = str(guild.name)
+    if len(name) > FLEET_NAME_LENGTH:
+        name = name[:FLEET_NAME_LENGTH - 1] + "…"
+    line = discord.utils.escape_markdown(name) + " (" + str(guild.id) + ") - " + str(guild.member_count or 0) + " members"
+    if settings.get(guild.id, 'ClockChannel') is not None:
+        line += " :clock3:"
+    return line
+
+fleet = GuildIndex()
+
+#common abbreviations for fixed offsets (in seconds), anything not in here is shown as a plain UTC offset
+TIMEZONE_NAMES = {
+    -12*3600: "IDLW", -11*3600: "NT", -10*3600: "HST", -34200: "MART", -9*3600: "AKST", -8*3600: "PST", -7*3600: "MST", -6*3600: "CST",
+    -5*3600: "EST", -4*3600: "AST", -12600: "NST", -3*3600: "ART", -2*3600: "AT", -1*3600: "WAT", 0: "GMT", 1*3600: "CET", 2*3600: "EET",
+    3*3600: "MSK", 12600: "IRST", 4*3600: "AMT", 16200: "AFT", 5*3600: "PKT", 19800: "IST", 20700: "NPT", 6*3600: "OMSK", 23400: "MMT",
+    7*3600: "KRAT", 8*3600: "CST", 31500: "ACWST", 9*3600: "JST", 34200: "ACST", 10*3600: "AEST", 37800: "LHST", 11*3600: "SAKT",
+    12*3600: "NZST", 45900: "CHAST", 13*3600: "TOT", 14*3600: "LINT",
+}
+
+#used to efficiently grab the name of a timezone based on an offset in seconds
+def timezoneget(offset):
+    offset = int(offset)
+    name = TIMEZONE_NAMES.get(offset)
+    if name is None:
+        sign = "-" if offset < 0 else "+"
+        hours, minutes = divmod(abs(offset) // 60, 60)
+        name = "UTC" + sign + str(hours) + ":" + str(minutes).zfill(2)
+    return name
+
+#turns a stored timezone into a tzinfo. Either an IANA name like "America/Vancouver", which follows daylight saving,
+#or an hour offset like -8 or 5.5 for the older fixed-offset settings. Returns None for anything unrecognizable.
+@functools.lru_cache(maxsize=None)
+def getTz(value):
+    try:
+        return datetime.timezone(datetime.timedelta(hours=float(value)))
+    except (TypeError, ValueError, OverflowError): #"inf" and the like parse as floats but are far too big for a timedelta
+        pass
+    try:
+        return zoneinfo.ZoneInfo(str(value))
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        return None
+
+#the short name shown next to a time, e.g. PDT for a zone or IST for a +5:30 offset
+def timezoneLabel(now):
+    if isinstance(now.tzinfo, zoneinfo.ZoneInfo):
+        return now.strftime("%Z")
+    return timezoneget(now.utcoffset().total_seconds())
+
+#every country's zones with their coordinates, read from the system's tz database (or the tzdata package where there isn't one)
+def loadCountryZones():
+    text = None
+    for directory in zoneinfo.TZPATH:
+        if os.path.exists(os.path.join(directory, "zone.tab")):
+            with open(os.path.join(directory, "zone.tab")) as tab:
+                text = tab.read()
+            break
+    if text is None:
+        try:
+            text = importlib.resources.files("tzdata").joinpath("zoneinfo/zone.tab").read_text()
+        except (ImportError, OSError):
+            return {}
+    zones = {}
+    for line in text.splitlines():
+        if line.startswith("#") or not line.strip():
+            continue
+        country, coords, name = line.split("\t")[:3]
+        split = max(coords.rfind("+"), coords.rfind("-"))
+        zones.setdefault(country, []).append((tabCoordinate(coords[:split]), tabCoordinate(coords[split:]), name))
+    return zones
+
+#zone.tab stores coordinates as +DDMM(SS) / +DDDMM(SS)
+def tabCoordinate(text):
+    sign = -1 if text[0] == "-" else 1
+    digits = text[1:]
+    degreeDigits = 2 if len(digits) in (4, 6) else 3
+    value = int(digits[:degreeDigits]) + int(digits[degreeDigits:degreeDigits + 2]) / 60
+    if len(digits) > degreeDigits + 2:
+        value += int(digits[degreeDigits + 2:]) / 3600
+    return sign * value
+
+#Works out a location's IANA zone once and remembers it, so !time is computed locally. The forecast (usually already cached)
+#provides the country, coordinates and current offset; the closest zone in that country with the same current offset wins.
+class ZoneResolver:
+    def __init__(self):
+        self.countryZones = None
+        self.resolved = {}  #normalized location -> (zone name or hour offset, city, country), for places the gazetteer doesn't know
+
+    async def resolve(self, location):
+        city = gazetteer.find(location)
+        if city is not None:
+            return (city[2], city[0], city[1]) #the gazetteer already knows the zone
+        location = gazetteer.forecastQuery(location).lower()
+        found = self.resolved.get(location)
+        if found is not None:
+            return found
+        response = await getForecast(location)
+        if not response.ok():
+            return response
+        found = (self.pickZone(response), response.city, response.country)
+        self.resolved[location] = found
+        return found
+
+    def pickZone(self, response):
+        if self.countryZones is None:
+            self.countryZones = loadCountryZones()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        best = None
+        for lat, lon, name in self.countryZones.get(response.country, []):
+            tz = getTz(name)
+            if tz is None or now.astimezone(tz).utcoffset().total_seconds() != response.timezone:
+                continue
+            distance = 0 if response.lat is None else (lat - response.lat) ** 2 + (lon - response.lon) ** 2
+            if best is None or distance < best[0]:
+                best = (distance, name)
+        if best is None:
+            return response.timezone / 3600 #no zone matches, fall back to the plain offset
+        return best[1]
+
+zones = ZoneResolver()
+
+#The help embeds are built once from "Resident-Clock-Help.json" and only rebuilt when the file changes, which is checked every so often
+HELP_FILE = 'Resident-Clock-Help.json'
+HELP_RELOAD_CHECK = 30  #seconds between checks for an edited help file
+
+class HelpCatalog:
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.checked = 0
+        self.reload()
+
+    def reload(self):
+        mtime = os.stat(self.path).st_mtime
+        with open(self.path) as json_file:
+            data = json.load(json_file)
+        overview = discord.Embed(title="Resident cLock Commands List", color=0xFFFF00)
+        overview.set_thumbnail(url="https://cdn.discordapp.com/attachments/800098126693138473/800164667489124372/big_funi.png")
+        perCommand = {}
+        for d in data['list']:
+            overview.add_field(name=("!" + d["id"]), value=d["Description"], inline=False)
+            embedVar = discord.Embed(title=("Help - " + d["Name"]), color=0xFFFF00)
+            embedVar.add_field(name="Description:", value=d["DetailedDesc"], inline=False)
+            embedVar.add_field(name="Usage:", value=d["Usage"], inline=False)
+            embedVar.add_field(name="Example:", value=d["Example"], inline=False)
+            if d["Image"]:
+                embedVar.set_image(url=d["Image"])
+            perCommand[str(d["id"]).lower()] = embedVar
+        self.overview = overview
+        self.commands = perCommand
+        self.notFound = discord.Embed(description="The command you've entered could not be found.", color=0xFF0000)
+        self.mtime = mtime
+
+    #reloads the catalog if the file was edited since it was last built. A broken edit keeps the last good catalog around.
+    def current(self):
+        now = monotonic()
+        if now - self.checked >= HELP_RELOAD_CHECK:
+            self.checked = now
+            try:
+                if os.stat(self.path).st_mtime != self.mtime:
+                    self.reload()
+            except (OSError, ValueError, KeyError) as e:
+                print("couldn't reload " + self.path + ": " + repr(e))
+        return self
+
+helpCatalog = HelpCatalog(HELP_FILE)
+
+#Quotes are held in memory as a flat list. New ones are appended to a small journal file instead of rewriting the whole quotes file,
+#and the journal gets folded back into "Resident-Clock-Quotes.json" once it grows long enough (and on shutdown).
+QUOTES_FILE = 'Resident-Clock-Quotes.json'
+QUOTES_JOURNAL = 'Resident-Clock-Quotes.journal'
+QUOTES_COMPACT_AFTER = 25   #journal entries to collect before compacting
+
+class QuotePool:
+    def __init__(self, path, journalPath):
+        self.path = path
+        self.journalPath = journalPath
+        self.quotes = []
+        self.journalled = 0
+        self.lock = None
+        self.load()
+
+    #every journal line records the quote's number, so lines that already made it into the quotes file are skipped if a compaction was interrupted
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path) as json_file:
+                data = json.load(json_file)
+            for d in data['quotes']:
+                self.quotes.extend(d.values())
+        if os.path.exists(self.journalPath):
+            with open(self.journalPath) as journal:
+                for line in journal:
+                    if line.strip():
+                        d = json.loads(line)
+                        if d['number'] > len(self.quotes):
+                            self.quotes.append(d['quote'])
+                            self.journalled += 1
+
+    def pick(self):
+        if self.quotes:
+            return random.choice(self.quotes)
+
+    async def add(self, text):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            self.quotes.append(text)
+            line = json.dumps({'number': len(self.quotes), 'quote': text}) + "\n"
+            await asyncio.get_event_loop().run_in_executor(None, self.appendJournal, line)
+            self.journalled += 1
+            if self.journalled >= QUOTES_COMPACT_AFTER:
+                await self.compactLocked()
+
+    def appendJournal(self, line):
+        with open(self.journalPath, 'a') as journal:
+            journal.write(line)
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    async def compact(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            await self.compactLocked()
+
+    async def compactLocked(self):
+        if self.journalled == 0:
+            return
+        snapshot = json.dumps({'quotes': [{str(idx + 1): text} for idx, text in enumerate(self.quotes)]}, indent='\t')
+        await asyncio.get_event_loop().run_in_executor(None, self.writeCompacted, snapshot)
+        self.journalled = 0
+
+    def writeCompacted(self, snapshot):
+        writeAtomic(self.path, snapshot)
+        os.remove(self.journalPath)
+
+quotes = QuotePool(QUOTES_FILE, QUOTES_JOURNAL)
+shutdownHooks.append(quotes.compact)
+
+#Moon phase engine. Everything works on numpy arrays, so one date and a whole month of dates cost about the same.
+MOON_EPOCH = numpy.datetime64('2001-01-01T00:00:00')
+MOON_EPOCH_POSITION = 0.20439731     #how far through the lunar cycle the moon was at the epoch
+MOON_RATE = 0.03386319269            #lunar cycles per day
+MOON_PHASES = [
+    ("New Moon", ":new_moon:", "https://cdn.discordapp.com/attachments/803372407133962251/803380642891956324/new-moon_1f311.png"),
+    ("Waxing Crescent", ":waxing_crescent_moon:", "https://cdn.discordapp.com/attachments/803372407133962251/803380679379124244/waxing-crescent-moon_1f312.png"),
+    ("First Quarter", ":first_quarter_moon:", "https://cdn.discordapp.com/attachments/803372407133962251/803380815592816670/first-quarter-moon_1f313.png"),
+    ("Waxing Gibbous", ":waxing_gibbous_moon:", "https://cdn.discordapp.com/attachments/803372407133962251/803380906005495818/waxing-gibbous-moon_1f314.png"),
+    ("Full Moon", ":full_moon:", "https://cdn.discordapp.com/attachments/803372407133962251/803380926306189333/full-moon_1f315.png"),
+    ("Waning Gibbous", ":waning_gibbous_moon:", "https://cdn.discordapp.com/attachments/803372407133962251/803380946149703730/waning-gibbous-moon_1f316.png"),
+    ("Last Quarter", ":last_quarter_moon:", "https://cdn.discordapp.com/attachments/803372407133962251/803380969310650378/last-quarter-moon_1f317.png"),
+    ("Waning Crescent", ":waning_crescent_moon:", "https://cdn.discordapp.com/attachments/803372407133962251/803380991019188244/waning-crescent-moon_1f318.png"),
+]
+MOON_EMOJI = numpy.array([phase[1] for phase in MOON_PHASES])
+
+#days since the epoch for a datetime64 value or array
+def moonDays(times):
+    return (numpy.asarray(times, dtype='datetime64[s]') - MOON_EPOCH) / numpy.timedelta64(1, 'D')
+
+#calculates moon position (0 to 1 through the lunar cycle) based on the date, for one date or an array of them
+def moonpos(times):
+    return (MOON_EPOCH_POSITION + moonDays(times) * MOON_RATE) % 1
+
+#which of the 8 named phases a position falls in
+def moonPhaseIndex(pos):
+    return numpy.floor(pos * 8 + 0.5).astype(int) % 8
+
+#fraction of the moon's face that is lit
+def moonIllumination(pos):
+    return (1 - numpy.cos(2 * numpy.pi * pos)) / 2
+
+#when the next new and full moons happen after the given times
+def moonNext(times, pos):
+    times = numpy.asarray(times, dtype='datetime64[s]')
+    pos = numpy.asarray(pos)
+    toNew = ((1 - pos) / MOON_RATE * 86400).astype('timedelta64[s]')
+    toFull = (((0.5 - pos) % 1) / MOON_RATE * 86400).astype('timedelta64[s]')
+    return times + toNew, times + toFull
+
+#every day of a month at noon UTC, rendered as a grid of phase emoji laid out by weekday
+def moonCalendar(year, month):
+    start = numpy.datetime64("%04d-%02d" % (year, month), 'M')
+    days = numpy.arange(start.astype('datetime64[D]'), (start + 1).astype('datetime64[D]'))
+    emoji = MOON_EMOJI[moonPhaseIndex(moonpos(days + numpy.timedelta64(12, 'h')))]
+    leading = int((days[0].astype('datetime64[D]').astype(int) + 3) % 7) #1970-01-01 was a Thursday, this makes Monday 0
+    cells = [":black_small_square:"] * leading + emoji.tolist()
+    rows = [" ".join(cells[idx:idx + 7]) for idx in range(0, len(cells), 7)]
+    return "Mo Tu We Th Fr Sa Su\n" + "\n".join(rows)
 
 #################################################
 
@@ -186,7 +1865,13 @@ def moonpos(dec, now=None):
 
 #Provides basic AQI data, takes an argument for a location
 @bot.command(name='AQI')
-async def cAQI(ctx, arg: str = None):
+async def cAQI(ctx, arg: str = None, *more):
+
+    locations = joinLocations((arg,) + more)
+    if len(locations) > 1:
+        await aqiComparison(ctx, locations)
+        return
+    arg = locations[0] if locations else None
 
     if arg is None:
         location = defaultGet("AQI_defaultCity", ctx.message.guild.id)
@@ -194,34 +1879,19 @@ async def cAQI(ctx, arg: str = None):
         location = arg
 
     # call the API
-    response = requests.get("https://api.waqi.info/feed/" + location + "/?token=" + AQIToken)
-    #print(response.status_code)
+    response = await getAQI(location)
 
-    if response.json()["status"] == "error":
-        embedVar = discord.Embed(description=("Error: Location returned no result."), color=0xFF0000)
+    if response["status"] == "error":
+        embedVar = discord.Embed(description=("Error: Location returned no result." + gazetteer.hint(location)), color=0xFF0000)
         await ctx.send(embed=embedVar)
         return
 
-    # json string
-    json_disco = response.text
-    device_disco = response.json()
+    device_disco = response
 
     IndexValue = device_disco['data']['aqi']
 
     IndexValue = int(IndexValue)
-
-    if IndexValue <= 50:
-        HealthLevel = "Good"
-    elif IndexValue <= 100:
-        HealthLevel = "Moderate"
-    elif IndexValue <= 150:
-        HealthLevel = "Unhealthy for Sensitive Groups"
-    elif IndexValue <= 200:
-        HealthLevel = "Unhealthy"
-    elif IndexValue <= 300:
-        HealthLevel = "Very Unhealthy"
-    elif IndexValue >= 301:
-        HealthLevel = "Hazardous"
+    HealthLevel = aqiHealthLevel(IndexValue)
 
     IndexValue = str(IndexValue)
 
@@ -232,6 +1902,19 @@ async def cAQI(ctx, arg: str = None):
     embedVar.add_field(name="᲼", value="API Data provided from [Here](https://aqicn.org)", inline=False)
     await ctx.send(embed=embedVar)
 
+def aqiHealthLevel(IndexValue):
+    if IndexValue <= 50:
+        return "Good"
+    elif IndexValue <= 100:
+        return "Moderate"
+    elif IndexValue <= 150:
+        return "Unhealthy for Sensitive Groups"
+    elif IndexValue <= 200:
+        return "Unhealthy"
+    elif IndexValue <= 300:
+        return "Very Unhealthy"
+    return "Hazardous"
+
 #Provides basic AQI data, takes an argument for a location, is more verbose
 @bot.command(name='detailed_AQI')
 async def dAQI(ctx, arg: str = None):
@@ -242,35 +1925,21 @@ async def dAQI(ctx, arg: str = None):
         location = arg
 
     # call the API
-    response = requests.get("https://api.waqi.info/feed/" + location + "/?token=" + AQIToken)
+    response = await getAQI(location)
 
-    if response.json()["status"] == "error":
-        embedVar = discord.Embed(description=("Error: Location returned no result."), color=0xFF0000)
+    if response["status"] == "error":
+        embedVar = discord.Embed(description=("Error: Location returned no result." + gazetteer.hint(location)), color=0xFF0000)
         await ctx.send(embed=embedVar)
         return
 
-    # json string
-    json_disco = response.text
-    device_disco = response.json()
+    device_disco = response
 
     IndexValue = device_disco['data']['aqi']
     data = device_disco['data']
 
 
     IndexValue = int(IndexValue)
-
-    if IndexValue <= 50:
-        HealthLevel = "Good"
-    elif IndexValue <= 100:
-        HealthLevel = "Moderate"
-    elif IndexValue <= 150:
-        HealthLevel = "Unhealthy for Sensitive Groups"
-    elif IndexValue <= 200:
-        HealthLevel = "Unhealthy"
-    elif IndexValue <= 300:
-        HealthLevel = "Very Unhealthy"
-    elif IndexValue >= 301:
-        HealthLevel = "Hazardous"
+    HealthLevel = aqiHealthLevel(IndexValue)
 
     IndexValue = str(IndexValue)
 
@@ -294,30 +1963,25 @@ async def dAQI(ctx, arg: str = None):
 #Provides the time at the selected timezone. Takes an argument for a location
 @bot.command(name='time')
 async def time(ctx, arg: str = None):
-    now = datetime.datetime.utcnow()
 
     if arg is None:
         location = defaultGet("defaultCity", ctx.message.guild.id)
     else:
         location = arg
 
-    location = location.replace(" ", "") #remove spaces and such so that api call is clean
-
-    # call the API
-    response = requests.get(
-        "https://api.openweathermap.org/data/2.5/forecast?q=" + location + "&%20exclude=current,minutely,hourly&cnt=1&appid=" + WeatherToken)
+    # only needs the API the first time a location is seen
+    found = await zones.resolve(location)
 
-    if (response.json()["cod"] == "404") or (response.json()["cod"] == "429"):
-        embedVar = discord.Embed(
-            description=("Error Code " + response.json()["cod"] + " :\n" + response.json()["message"]), color=0xFF0000)
-        await ctx.send(embed=embedVar)
+    if isinstance(found, Forecast):
+        await ctx.send(embed=forecastErrorEmbed(found, location))
         return
 
-    now += datetime.timedelta(seconds=response.json()["city"]["timezone"])
+    zone, city, country = found
+    now = datetime.datetime.now(getTz(zone))
 
     embedVar = discord.Embed(title=("Current Time:"), description=(now.strftime("**%-I:%M:%S %p**\n**%a, %-d/%-m/%Y**")), color=0x404040)
-    embedVar.add_field(name="Location: ", value=(response.json()["city"]["name"] + "\n" + response.json()["city"]["country"]), inline=True)
-    embedVar.add_field(name="Timezone:", value=(timezoneget(response.json()["city"]["timezone"]) + "\nOffset: " + str(response.json()["city"]["timezone"])), inline=True)
+    embedVar.add_field(name="Location: ", value=(city + "\n" + country), inline=True)
+    embedVar.add_field(name="Timezone:", value=(timezoneLabel(now) + "\nOffset: " + str(int(now.utcoffset().total_seconds()))), inline=True)
 
     await ctx.send(embed=embedVar)
 
@@ -333,7 +1997,13 @@ async def pingpog(ctx):
 
 #provides current temperature at the selected location. Can take an argument for the location
 @bot.command(name='temperature')
-async def temperature(ctx, arg: str = None):
+async def temperature(ctx, arg: str = None, *more):
+
+    locations = joinLocations((arg,) + more)
+    if len(locations) > 1:
+        await temperatureComparison(ctx, locations)
+        return
+    arg = locations[0] if locations else None
 
     if arg is None:
         location = defaultGet("defaultCity", ctx.message.guild.id)
@@ -341,34 +2011,21 @@ async def temperature(ctx, arg: str = None):
         location = arg
 
     # call the API
-    response = requests.get(
-        "https://api.openweathermap.org/data/2.5/forecast?q=" + location + "&%20exclude=current,minutely,hourly&appid=" + WeatherToken)
-    # print(response.status_code)
+    response = await getForecast(location)
 
-    # jprint(response.json())
-
-    if (response.json()["cod"] == "404") or (response.json()["cod"] == "429"):
-        embedVar = discord.Embed(description=("Error Code " + response.json()["cod"] + " :\n" + response.json()["message"]), color=0xFF0000)
-        await ctx.send(embed=embedVar)
+    if not response.ok():
+        await ctx.send(embed=forecastErrorEmbed(response, location))
         return
 
-    # json string
-    Daily = response.json()['list']
-    # jprint(Daily)
+    current = response.entries[0]
 
     # initial print value for the forecast copypasta
-    embedVar = discord.Embed(title="Today's Temperature is:", description=("Selected Location: " + str(response.json()['city']['name']) + ", " + str(response.json()['city']['country'])), color=0x404040)
+    embedVar = discord.Embed(title="Today's Temperature is:", description=("Selected Location: " + response.city + ", " + response.country), color=0x404040)
     embedVar.set_thumbnail(url="https://cdn.discordapp.com/attachments/800098126693138473/800455530762076180/logo.png")
 
-
-    # Gets the temperature and converts it from Kelvin to Celsius
-    Temperature = str(round(int(Daily[0]['main']['temp']) - 273.15, 2))
-    # Prints the temperature
-    embedVar.add_field(name="Temperature: ", value=(Temperature + " °C"), inline=True)
-    # Gets the feels like temperature and converts it from Kelvin to Celsius
-    FeelsLike = str(round(int(Daily[0]['main']['feels_like']) - 273.15, 2))
-    # Prints the feels like temperature and a new line to prepare for additional forecasts
-    embedVar.add_field(name="Feels Like: ", value=(FeelsLike + " °C"), inline=True)
+    # Prints the temperature and the feels like temperature
+    embedVar.add_field(name="Temperature: ", value=(str(current.temp) + " °C"), inline=True)
+    embedVar.add_field(name="Feels Like: ", value=(str(current.feelsLike) + " °C"), inline=True)
 
     embedVar.add_field(name="᲼", value="API Data provided from [Here](https://openweathermap.org/)", inline=False)
     await ctx.send(embed=embedVar)
@@ -382,15 +2039,56 @@ async def invite(ctx):
         url="https://cdn.discordapp.com/attachments/800098126693138473/800164667489124372/big_funi.png")
     await ctx.send(embed=embedVar)
 
+#The cat and dog APIs hand out up to 10 pictures per request, so rather than asking for one every time, a batch is kept on hand and
+#each command takes the next one. When the pool drops below the low-water mark it's topped up in the background with one request.
+IMAGE_BATCH = 10
+IMAGE_LOW_WATER = 4
+IMAGE_POOL_SIZE = 30
+
+class ImagePool:
+    def __init__(self, name, url):
+        self.name = name
+        self.url = url
+        self.urls = deque(maxlen=IMAGE_POOL_SIZE)
+        self.refills = {}   #priority -> the top-up running at that priority
+
+    async def fetch(self, priority):
+        response = await httpGet(self.url, params={'limit': IMAGE_BATCH}, quota=self.name, priority=priority)
+        if isinstance(response, list):
+            self.urls.extend(image['url'] for image in response if isinstance(image, dict) and image.get('url') and image['url'] not in self.urls)
+
+    def running(self, priority):
+        task = self.refills.get(priority)
+        return task is not None and not task.done()
+
+    #Starts a top-up unless one is already running, so a burst of commands on an empty pool still only costs one request. Someone
+    #waiting on a picture never queues behind a background top-up though, that would put them behind background work for the quota.
+    def refill(self, priority=PRIORITY_BACKGROUND):
+        if not self.running(priority) and not (priority == PRIORITY_BACKGROUND and self.running(PRIORITY_INTERACTIVE)):
+            task = self.refills[priority] = asyncio.ensure_future(self.fetch(priority))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception()) #a failed top-up is retried by the next command
+        return self.refills[priority]
+
+    async def take(self):
+        if not self.urls:
+            await asyncio.shield(self.refill(PRIORITY_INTERACTIVE))
+            if not self.urls:
+                raise UpstreamError("The " + self.name + " API didn't send any pictures, please try again later.")
+        URL = self.urls.popleft()
+        if len(self.urls) < IMAGE_LOW_WATER:
+            self.refill()
+        return URL
+
+catImages = ImagePool('cat', CAT_URL)
+dogImages = ImagePool('dog', DOG_URL)
+metrics.gauge('image_pool_size', lambda: {(('pool', pool.name),): len(pool.urls) for pool in (catImages, dogImages)}, "Pictures waiting in each image pool.")
+
 #sends a random cat picture
 @bot.command(name='meow')
 async def catAPI(ctx):
 
-    # call the API
-    response = requests.get("https://api.thecatapi.com/v1/images/search")
-
-    # json string
-    URL = response.json()[0]['url']
+    # comes straight out of the prefetched pool, the API is only called when it runs low
+    URL = await catImages.take()
 
     # create an embed and set its colour
     embedVar = discord.Embed(color=0x404040)
@@ -402,11 +2100,8 @@ async def catAPI(ctx):
 @bot.command(name='woof')
 async def dogAPI(ctx):
 
-    # call the API
-    response = requests.get("https://api.thedogapi.com/v1/images/search")
-
-    # json string
-    URL = response.json()[0]['url']
+    # comes straight out of the prefetched pool, the API is only called when it runs low
+    URL = await dogImages.take()
 
     # create an embed and set its colour
     embedVar = discord.Embed(color=0x404040)
@@ -414,30 +2109,46 @@ async def dogAPI(ctx):
     embedVar.set_image(url=URL)
     await ctx.send(embed=embedVar)
 
+#turns a mention like <@!1234> or <@1234>, or a plain ID, into an int. Returns None if it's neither.
+def parseUserID(arg):
+    match = re.fullmatch(r"<@!?(\d+)>|(\d+)", str(arg).strip())
+    if match is not None:
+        return int(match.group(1) or match.group(2))
+
+#a user's name from the member cache, only asking Discord if they aren't cached
+async def userName(ctx, userID):
+    user = (ctx.guild.get_member(userID) if ctx.guild is not None else None) or bot.get_user(userID)
+    if user is None:
+        try:
+            user = await bot.fetch_user(userID)
+        except discord.HTTPException:
+            return str(userID)
+    return user.display_name
+
 #requires Mee6, compares XP between two users.
 @bot.command(name='cmpxp')
 async def compareXP(ctx, userID1 = None, userID2 = None):
 
-    mee6API = API(ctx.guild.id)
-
-    if userID1 == None:
+    if userID1 == None or parseUserID(userID1) is None:
         await ctx.send('Error! You must either mention the user or input their ID. Use `!help cmpxp` for a more detailed explanation.')
         return
-    elif userID1.startswith('<@!'):
-        userID1 = userID1.replace('<@!', '')
-        userID1 = userID1.replace('>', '')
+    userID1 = parseUserID(userID1)
 
-    if userID2 == None:
+    if userID2 == None or parseUserID(userID2) is None:
         userID2 = ctx.author.id
-    elif userID2.startswith('<@!'):
-        userID2 = userID2.replace('<@!', '')
-        userID2 = userID2.replace('>', '')
-
-    user_details = await mee6API.levels.get_user_xp(str(userID1), page_count_limit=1)
-    user_details = int(user_details)
-    another_user_details = await mee6API.levels.get_user_xp(str(userID2), page_count_limit=1)
-    another_user_details = int(another_user_details)
-    deltaXP = another_user_details - user_details
+    else:
+        userID2 = parseUserID(userID2)
+
+    board, username1, username2 = await asyncio.gather(getLeaderboard(ctx.guild.id), userName(ctx, userID1), userName(ctx, userID2))
+    if board.error is not None:
+        await ctx.send("Error! " + board.error)
+        return
+    for userID, username in ((userID1, username1), (userID2, username2)):
+        if userID not in board.players:
+            await ctx.send("Error! " + username + " isn't on this server's Mee6 leaderboard yet.")
+            return
+
+    deltaXP = board.players[userID2][2] - board.players[userID1][2]
     if deltaXP > 0:
         User1Leads = True
     else:
@@ -445,17 +2156,65 @@ async def compareXP(ctx, userID1 = None, userID2 = None):
         deltaXP *= -1
     deltaXP = str(deltaXP)
 
-    username1 = await bot.fetch_user(userID1)
-    username2 = await bot.fetch_user(userID2)
     if User1Leads:
-        embedVar = discord.Embed(title=("Comparing XP between " + username1.display_name + " and " + username2.display_name + ":"), description=("<@" + str(userID2) + ">" + " has a lead on " + "<@" + str(userID1) + ">" + " by " + deltaXP + " XP."), color=0x404040)
+        embedVar = discord.Embed(title=("Comparing XP between " + username1 + " and " + username2 + ":"), description=("<@" + str(userID2) + ">" + " has a lead on " + "<@" + str(userID1) + ">" + " by " + deltaXP + " XP."), color=0x404040)
     else:
-        embedVar = discord.Embed(title=("Comparing XP between " + username1.display_name + " and " + username2.display_name + ":"),description=("<@" + str(userID1) + ">" + " has a lead on " + "<@" + str(userID2) + ">" + " by " + deltaXP + " XP."), color=0x404040)
+        embedVar = discord.Embed(title=("Comparing XP between " + username1 + " and " + username2 + ":"),description=("<@" + str(userID1) + ">" + " has a lead on " + "<@" + str(userID2) + ">" + " by " + deltaXP + " XP."), color=0x404040)
+    await ctx.send(embed=embedVar)
+
+#requires Mee6, shows a user's rank, level and XP. Defaults to whoever used the command
+@bot.command(name='rank')
+async def rank(ctx, userID = None):
+    userID = parseUserID(userID) if userID is not None else ctx.author.id
+    if userID is None:
+        await ctx.send('Error! You must either mention the user or input their ID. Use `!help rank` for a more detailed explanation.')
+        return
+
+    board, username = await asyncio.gather(getLeaderboard(ctx.guild.id), userName(ctx, userID))
+    if board.error is not None:
+        await ctx.send("Error! " + board.error)
+        return
+    if userID not in board.players:
+        await ctx.send("Error! " + username + " isn't on this server's Mee6 leaderboard yet.")
+        return
+
+    position, level, xp, name = board.players[userID]
+    embedVar = discord.Embed(title=(username + "'s Rank"), color=0x404040)
+    embedVar.add_field(name="Rank:", value=("#" + str(position) + " of " + str(len(board.ranking))), inline=True)
+    embedVar.add_field(name="Level:", value=str(level), inline=True)
+    embedVar.add_field(name="XP:", value=str(xp), inline=True)
+    await ctx.send(embed=embedVar)
+
+#requires Mee6, shows one page of the server's leaderboard
+LEADERBOARD_PAGE_SIZE = 10
+
+@bot.command(name='leaderboard')
+async def leaderboard(ctx, page: int = 1):
+    board = await getLeaderboard(ctx.guild.id)
+    if board.error is not None:
+        await ctx.send("Error! " + board.error)
+        return
+
+    pages = max(1, math.ceil(len(board.ranking) / LEADERBOARD_PAGE_SIZE))
+    page = min(max(page, 1), pages)
+    lines = []
+    for userID in board.ranking[(page - 1) * LEADERBOARD_PAGE_SIZE:page * LEADERBOARD_PAGE_SIZE]:
+        position, level, xp, name = board.players[userID]
+        lines.append("**#" + str(position) + "** <@" + str(userID) + "> - Level " + str(level) + " (" + str(xp) + " XP)")
+    embedVar = discord.Embed(title="Mee6 Leaderboard", description=("\n".join(lines) or "Nobody has any XP yet."), color=0x404040)
+    embedVar.set_footer(text=("Page " + str(page) + " of " + str(pages)))
     await ctx.send(embed=embedVar)
 
 #Absolute chonker of a command that can provide either a daily or a multi-day weather forecast.
 @bot.command(name='forecast')
-async def forecast(ctx, arg1: str = None, arg2: str = None):
+async def forecast(ctx, arg1: str = None, arg2: str = None, *more):
+
+    # more than one city means a side by side comparison, handled separately
+    words = joinLocations((arg1, arg2) + more)
+    if len([x for x in words if not x.isdigit() and not any(day in x.lower() for day in WEEKDAYS)]) > 1:
+        await forecastComparison(ctx, words)
+        return
+    arg1, arg2 = (words + [None, None])[:2]
 
     # absolute unit of a determinator to find what type of argument was added.
     SingleDay = False
@@ -536,23 +2295,16 @@ async def forecast(ctx, arg1: str = None, arg2: str = None):
 
 
 
-    #remove spaces so that country codes don't have to look like trash when you input them
-    location = location.replace(" ", "")
     dayparameter = str(dayparameter)
     dayparameter = dayparameter.replace(" ", "")
 
     # call the API
-    response = requests.get("https://api.openweathermap.org/data/2.5/forecast?q=" + location + "&%20exclude=current,minutely,hourly&appid=" + WeatherToken)
+    response = await getForecast(location)
 
-    if (response.json()["cod"] == "404") or (response.json()["cod"] == "429"):
-        embedVar = discord.Embed(description=("Error Code " + response.json()["cod"] + " :\n" + response.json()["message"]), color=0xFF0000)
-        await ctx.send(embed=embedVar)
+    if not response.ok():
+        await ctx.send(embed=forecastErrorEmbed(response, location))
         return
 
-    # json string
-    Timezone = response.json()['city']['timezone']
-    Daily = response.json()['list']
-
     if SingleDay is False:
 
         dayparameter = int(dayparameter)
@@ -562,95 +2314,11 @@ async def forecast(ctx, arg1: str = None, arg2: str = None):
             dayparameter = 5
 
         # initial print value for the forecast copypasta
-        embedVar = discord.Embed(title="The forecast for the next " + str(dayparameter) + " days in " + str(response.json()['city']['name']) + " is:", description=("Selected Location: " + str(response.json()['city']['name']) + ", " + str(response.json()['city']['country'])), color=0x404040)
+        embedVar = discord.Embed(title="The forecast for the next " + str(dayparameter) + " days in " + response.city + " is:", description=("Selected Location: " + response.city + ", " + response.country), color=0x404040)
         embedVar.set_thumbnail(url="https://cdn.discordapp.com/attachments/800098126693138473/800455530762076180/logo.png")
 
-        thing = True
-        currentday = 0
-        # cycles through today and the next 7 days to get all the forecast data in
-        for d in Daily:
-            # grabbing the date from the API
-            epoch_time = d['dt'] + Timezone
-            Date = datetime.datetime.fromtimestamp(epoch_time)
-
-            if (any(x in str(Date.hour) for x in ['11', '12', '13'] or thing == True) and currentday < dayparameter):
-
-                thing = False
-                currentday += 1
-
-                # gets the current weather description
-                WeatherDesc = str(d['weather'][0]['description'])
-                # finds the correct Emoji to use
-                ID = str(d['weather'][0]["icon"])
-                Emoji = ":face_with_symbols_over_mouth:"
-                if ID == "01d":
-                    # Clear Day
-                    Emoji = ":sunny:"
-                if ID == "01n":
-                    # Clear Night
-                    Emoji = ":new_moon:"
-                if ID == "02d":
-                    # few clouds
-                    Emoji = ":white_sun_small_cloud:"
-                if ID == "02n":
-                    # few clouds
-                    Emoji = ":white_sun_small_cloud:"
-                if ID == "03d":
-                    # scattered clouds
-                    Emoji = ":white_sun_cloud:"
-                if ID == "03n":
-                    # scattered clouds
-                    Emoji = ":white_sun_cloud:"
-                if ID == "04d":
-                    # overcast
-                    Emoji = ":cloud:"
-                if ID == "04n":
-                    # overcast
-                    Emoji = ":cloud:"
-                if ID == "09d":
-                    # showers
-                    Emoji = ":cloud_rain:"
-                if ID == "09n":
-                    # showers
-                    Emoji = ":cloud_rain:"
-                if ID == "10d":
-                    # rain
-                    Emoji = ":white_sun_rain_cloud:"
-                if ID == "10n":
-                    # rain
-                    Emoji = ":white_sun_rain_cloud:"
-                if ID == "11d":
-                    # thunder
-                    Emoji = ":thunder_cloud_rain:"
-                if ID == "11n":
-                    # thunder
-                    Emoji = ":thunder_cloud_rain:"
-                if ID == "13d":
-                    # snow
-                    Emoji = ":cloud_snow:"
-                if ID == "13n":
-                    # snow
-                    Emoji = ":cloud_snow:"
-                if ID == "50d":
-                    # fog
-                    Emoji = ":fog:"
-                if ID == "50n":
-                    # fog
-                    Emoji = ":fog:"
-
-                Title = (Date.strftime("%A, %b %#d: ") + Emoji)
-                # Prints Emoji and Weather Description Values
-                Desc = ("Weather:   " + WeatherDesc + '\n')
-                # Gets the temperature and converts it from Kelvin to Celsius
-                Temperature = str(round(int(d['main']['temp']) - 273.15, 2))
-                # Prints the temperature
-                Desc += ("Temp: " + Temperature + " °C" + '\n')
-                # Gets the feels like temperature and converts it from Kelvin to Celsius
-                FeelsLike = str(round(int(d['main']['feels_like']) - 273.15, 2))
-                # Prints the feels like temperature and a new line to prepare for additional forecasts
-                Desc += (
-                            "Feels like: " + FeelsLike + " °C")
-                embedVar.add_field(name=Title, value=Desc, inline=True)
+        for d in response.daily(dayparameter):
+            embedVar.add_field(name=(d.time.strftime("%A, %b ") + str(d.time.day) + ": " + d.emoji), value=forecastEntryText(d), inline=True)
 
         embedVar.add_field(name="᲼", value="API Data provided from [Here](https://openweathermap.org/)", inline=False)
         await ctx.send(embed=embedVar)
@@ -658,185 +2326,224 @@ async def forecast(ctx, arg1: str = None, arg2: str = None):
     if SingleDay is True:
 
         dayparameter = dayparameter.lower()
-        # json string
-        Daily = response.json()['list']
-        Timezone = response.json()['city']['timezone']
+        if (dayparameter == "currentdate"):
+            dayparameter = response.today()
 
-        isdaytoday = False
+        entries = response.days.get(dayparameter)
+        if entries is None:
+            await ctx.send("Specified Day out of Range, please try a different day, use `!help forecast` for more information.")
+            return
 
-        # initial print value for the forecast copypasta
-        if (dayparameter == "currentdate"):
-            isdaytoday = True
-            Now = datetime.datetime.now()
-            Now += datetime.timedelta(seconds= Timezone)
-            dayparameter = Now.strftime("%A")
-
-        currentday = 0
-        DayWasFound = False
-        # cycles through today and the next 7 days to get all the forecast data in
-        for d in Daily:
-            # grabbing the date from the API
-            epoch_time = d['dt'] - Timezone
-            Date = datetime.datetime.fromtimestamp(epoch_time)
-            if (dayparameter.lower() == Date.strftime("%A").lower()):
-                if DayWasFound is False and isdaytoday is False:
-                    embedVar = discord.Embed(title=Date.strftime("The forecast for %A, %b %#d, in ") + str(response.json()['city']['name']) + " is:", description=("Selected Location: " + str(response.json()['city']['name']) + ", " + str(response.json()['city']['country'])), color=0x404040)
-                    embedVar.set_thumbnail(url="https://cdn.discordapp.com/attachments/800098126693138473/800455530762076180/logo.png")
-                DayWasFound = True
-                currentday += 1
-                # printing the date
-                # gets the current weather description
-                WeatherDesc = str(d['weather'][0]['description'])
-                # finds the correct Emoji to use
-                ID = str(d['weather'][0]["icon"])
-                Emoji = ":face_with_symbols_over_mouth:"
-                if ID == "01d" or ID == "01n":
-                    # Clear Day/Night
-                    if Date.hour > 7 and Date.hour < 18:
-                        Emoji = ":sunny:"
-                    else:
-                        Emoji = ":new_moon:"
-                if ID == "02d":
-                    # few clouds
-                    Emoji = ":white_sun_small_cloud:"
-                if ID == "02n":
-                    # few clouds
-                    Emoji = ":white_sun_small_cloud:"
-                if ID == "03d":
-                    # scattered clouds
-                    Emoji = ":white_sun_cloud:"
-                if ID == "03n":
-                    # scattered clouds
-                    Emoji = ":white_sun_cloud:"
-                if ID == "04d":
-                    # overcast
-                    Emoji = ":cloud:"
-                if ID == "04n":
-                    # overcast
-                    Emoji = ":cloud:"
-                if ID == "09d":
-                    # showers
-                    Emoji = ":cloud_rain:"
-                if ID == "09n":
-                    # showers
-                    Emoji = ":cloud_rain:"
-                if ID == "10d":
-                    # rain
-                    Emoji = ":white_sun_rain_cloud:"
-                if ID == "10n":
-                    # rain
-                    Emoji = ":white_sun_rain_cloud:"
-                if ID == "11d":
-                    # thunder
-                    Emoji = ":thunder_cloud_rain:"
-                if ID == "11n":
-                    # thunder
-                    Emoji = ":thunder_cloud_rain:"
-                if ID == "13d":
-                    # snow
-                    Emoji = ":cloud_snow:"
-                if ID == "13n":
-                    # snow
-                    Emoji = ":cloud_snow:"
-                if ID == "50d":
-                    # fog
-                    Emoji = ":fog:"
-                if ID == "50n":
-                    # fog
-                    Emoji = ":fog:"
-
-                Title = (Date.strftime("%-I:%M %p: ") + Emoji)
-                # Prints Emoji and Weather Description Values
-                Desc = ("Weather:   " + WeatherDesc + '\n')
-                # Gets the temperature and converts it from Kelvin to Celsius
-                Temperature = str(round(int(d['main']['temp']) - 273.15, 2))
-                # Prints the temperature
-                Desc += ("Temp: " + Temperature + " °C" + '\n')
-                # Gets the feels like temperature and converts it from Kelvin to Celsius
-                FeelsLike = str(round(int(d['main']['feels_like']) - 273.15, 2))
-                # Prints the feels like temperature and a new line to prepare for additional forecasts
-                Desc += ("Feels like: " + FeelsLike + " °C")
-                embedVar.add_field(name=Title, value=Desc, inline=True)
-
-        if DayWasFound is True:
-            embedVar.add_field(name="᲼", value="API Data provided from [Here](https://openweathermap.org/)", inline=False)
-            await ctx.send(embed=embedVar)
+        Date = entries[0].time
+        embedVar = discord.Embed(title=Date.strftime("The forecast for %A, %b ") + str(Date.day) + ", in " + response.city + " is:", description=("Selected Location: " + response.city + ", " + response.country), color=0x404040)
+        embedVar.set_thumbnail(url="https://cdn.discordapp.com/attachments/800098126693138473/800455530762076180/logo.png")
+        for d in entries:
+            Emoji = d.emoji
+            if d.icon.startswith("01"):
+                # Clear Day/Night
+                Emoji = ":sunny:" if 7 < d.time.hour < 18 else ":new_moon:"
+            embedVar.add_field(name=(d.time.strftime("%-I:%M %p: ") + Emoji), value=forecastEntryText(d), inline=True)
+
+        embedVar.add_field(name="᲼", value="API Data provided from [Here](https://openweathermap.org/)", inline=False)
+        await ctx.send(embed=embedVar)
+
+#the weather description and temperatures for one forecast entry
+def forecastEntryText(d):
+    return "Weather:   " + d.description + "\nTemp: " + str(d.temp) + " °C\nFeels like: " + str(d.feelsLike) + " °C"
+
+def forecastErrorEmbed(response, location=None):
+    return discord.Embed(description=("Error Code " + response.cod + " :\n" + str(response.message) + forecastHint(response, location)), color=0xFF0000)
+
+#only a "city not found" is worth suggesting another spelling for
+def forecastHint(response, location):
+    return gazetteer.hint(location) if response.cod == "404" else ""
+
+#Several cities can be given to !forecast, !temperature and !AQI to compare them in one message. They're all looked up at the same
+#time (a few at once, so one command can't swamp the APIs), and the results go into a single table.
+COMPARE_MAX_LOCATIONS = 10
+COMPARE_CONCURRENCY = 4
+COMPARE_NAME_LENGTH = 18    #city names are cut to this so the table still fits on a phone screen
+COMPARE_FORECAST_DAYS = 3
+
+#looks every location up with fetch, a few at a time. Each result is either what fetch returned or the error it raised, in the order given.
+async def fetchLocations(locations, fetch):
+    semaphore = asyncio.Semaphore(COMPARE_CONCURRENCY)
+    async def one(location):
+        async with semaphore:
+            try:
+                return await fetch(location)
+            except UpstreamError as e:
+                return e
+    return await asyncio.gather(*(one(location) for location in locations))
+
+#Unquoted locations arrive one word at a time. Words that together name a known city ("New York", "Los Angeles, US") are kept as one
+#location, taking the longest name that fits, so only genuinely separate cities turn into a comparison. An unknown "Victoria, CA"
+#arrives as "Victoria," and "CA", so anything else ending in a comma is joined back up with what follows it.
+def joinLocations(words):
+    words = [word for word in words if word is not None]
+    joined = []
+    start = 0
+    while start < len(words):
+        for end in range(len(words), start + 1, -1):
+            if gazetteer.find(" ".join(words[start:end])) is not None:
+                joined.append(" ".join(words[start:end]))
+                start = end
+                break
         else:
-            await ctx.send("Specified Day out of Range, please try a different day, use `!help forecast` for more information.")
+            if joined and joined[-1].endswith(","):
+                joined[-1] += " " + words[start]
+            else:
+                joined.append(words[start])
+            start += 1
+    return joined
+
+#the same city asked for twice only gets looked up once, and there's a cap so the embed stays readable
+def compareLocations(locations):
+    unique = []
+    for location in locations:
+        if normalizeLocation(location) not in [normalizeLocation(x) for x in unique]:
+            unique.append(location)
+    return unique[:COMPARE_MAX_LOCATIONS]
+
+#lines up rows of text into columns inside a code block, with the locations that couldn't be looked up listed underneath
+def compareTable(header, rows, errors):
+    parts = []
+    if rows:
+        widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+        lines = ["  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in [header] + rows]
+        parts.append("```\n" + "\n".join(lines) + "\n```")
+    if errors:
+        parts.append(compareErrors(errors))
+    return "\n".join(parts)
+
+def compareName(name):
+    return name if len(name) <= COMPARE_NAME_LENGTH else name[:COMPARE_NAME_LENGTH - 1] + "…"
+
+#the locations that couldn't be looked up, and why, to go under the table
+def compareErrors(errors):
+    return "\n".join("**" + location + "**: " + reason for location, reason in errors)
+
+async def temperatureComparison(ctx, locations):
+    locations = compareLocations(locations)
+    rows, errors = [], []
+    for location, response in zip(locations, await fetchLocations(locations, getForecast)):
+        if isinstance(response, Exception):
+            errors.append((location, str(response)))
+        elif not response.ok():
+            errors.append((location, "Error Code " + response.cod + ": " + str(response.message) + forecastHint(response, location)))
+        else:
+            current = response.entries[0]
+            rows.append([compareName(response.city + ", " + response.country), str(current.temp) + " °C", str(current.feelsLike) + " °C", current.description])
+
+    embedVar = discord.Embed(title="Today's Temperatures:", description=compareTable(["Location", "Temp", "Feels", "Weather"], rows, errors), color=0x404040)
+    embedVar.set_thumbnail(url="https://cdn.discordapp.com/attachments/800098126693138473/800455530762076180/logo.png")
+    embedVar.add_field(name="᲼", value="API Data provided from [Here](https://openweathermap.org/)", inline=False)
+    await ctx.send(embed=embedVar)
+
+async def aqiComparison(ctx, locations):
+    locations = compareLocations(locations)
+    rows, errors = [], []
+    for location, response in zip(locations, await fetchLocations(locations, getAQI)):
+        if isinstance(response, Exception):
+            errors.append((location, str(response)))
+        elif response["status"] == "error" or not str(response['data']['aqi']).isdigit():
+            errors.append((location, "Location returned no result." + gazetteer.hint(location)))
+        else:
+            IndexValue = int(response['data']['aqi'])
+            rows.append([compareName(location.capitalize()), str(IndexValue), aqiHealthLevel(IndexValue)])
+
+    embedVar = discord.Embed(title="Air Quality Index", description=compareTable(["Location", "AQI", "Status"], rows, errors), color=0x404040)
+    embedVar.set_thumbnail(url="https://cdn.discordapp.com/attachments/800098126693138473/800453985647460382/logo.png")
+    embedVar.add_field(name="᲼", value="API Data provided from [Here](https://aqicn.org)", inline=False)
+    await ctx.send(embed=embedVar)
+
+#a number picks how many days to show (up to 5), everything else is a location. A weekday can't be compared across cities' timezones.
+async def forecastComparison(ctx, words):
+    if any(day in x.lower() for x in words for day in WEEKDAYS):
+        await ctx.send("Error, a day of the week can't be used when comparing cities, use a number of days instead. Use `!help forecast` for more information.")
+        return
+    days = COMPARE_FORECAST_DAYS
+    locations = []
+    for x in words:
+        if x.isdigit():
+            days = min(max(int(x), 1), 5)
+        else:
+            locations.append(x)
+    locations = compareLocations(locations)
+
+    embedVar = discord.Embed(title=("The forecast for the next " + str(days) + " days:"), color=0x404040)
+    embedVar.set_thumbnail(url="https://cdn.discordapp.com/attachments/800098126693138473/800455530762076180/logo.png")
+    errors = []
+    for location, response in zip(locations, await fetchLocations(locations, getForecast)):
+        if isinstance(response, Exception):
+            errors.append((location, str(response)))
+        elif not response.ok():
+            errors.append((location, "Error Code " + response.cod + ": " + str(response.message) + forecastHint(response, location)))
+        else:
+            lines = [d.time.strftime("%a: ") + d.emoji + " " + str(d.temp) + " °C" for d in response.daily(days)]
+            embedVar.add_field(name=(response.city + ", " + response.country), value="\n".join(lines), inline=True)
+    if errors:
+        embedVar.description = compareErrors(errors)
+    embedVar.add_field(name="᲼", value="API Data provided from [Here](https://openweathermap.org/)", inline=False)
+    await ctx.send(embed=embedVar)
 
 #generator to print all or specific help commands
 @bot.command(name='help')
 async def help(ctx, arg: str = None):
-    with open('Resident-Clock-Help.json') as json_file:
-        data = json.load(json_file)
+    catalog = helpCatalog.current()
     if arg is None:
-        embedVar = discord.Embed(title="Resident cLock Commands List", color=0xFFFF00)
-        embedVar.set_thumbnail(url="https://cdn.discordapp.com/attachments/800098126693138473/800164667489124372/big_funi.png")
-        for d in data['list']:
-            embedVar.add_field(name=("!" + d["id"]), value=d["Description"],inline=False)
-        await ctx.send(embed=embedVar)
+        await ctx.send(embed=catalog.overview)
     else:
-        for d in data["list"]:
-            if arg.lower() == str(d["id"]).lower():
-                embedVar = discord.Embed(title=("Help - " + d["Name"]), color=0xFFFF00)
-                embedVar.add_field(name="Description:", value=d["DetailedDesc"], inline=False)
-                embedVar.add_field(name="Usage:", value=d["Usage"], inline=False)
-                embedVar.add_field(name="Example:", value=d["Example"], inline=False)
-                embedVar.set_image(url=d["Image"])
-                await ctx.send(embed=embedVar)
-                return
-        embedVar = discord.Embed(description="The command you've entered could not be found.", color=0xFF0000)
-        await ctx.send(embed=embedVar)
+        await ctx.send(embed=catalog.commands.get(arg.lower(), catalog.notFound))
 
 #Bot will spit out a random quote from a list of supplied quotes from "Resident-Clock-Quotes.json"
 @bot.command(name='quote')
 async def quote(ctx):
-    with open('Resident-Clock-Quotes.json', "r") as json_file:
-        data = json.load(json_file)
-        temp = data['quotes']
-        quotenum = len(temp)
-        index = random.randint(1, quotenum)
-        await ctx.send(temp[index-1][str(index)])
-
-#Provides the currrent moon phase along with an emote
+    text = quotes.pick()
+    if text is None:
+        await ctx.send("I'm all out of witty things to say.")
+        return
+    await ctx.send(text)
+
+#Provides the moon phase along with an emote. Takes an optional date (YYYY-MM-DD), or "month"/YYYY-MM for a whole month's calendar
 @bot.command(name='moonie')
-async def moonie(ctx):
-    dec = decimal.Decimal
-
-    pos = moonpos(dec)
-    index = (pos * dec(8)) + dec("0.5")
-    roundedpos = round(float(pos), 3)
-    index = math.floor(index)
-    index = int(index)
-    if index == 8:
-        index = 0
-
-    embedVar = discord.Embed(title="Current Moon Phase", color=0x404040)
-
-    if index == 0:
-        embedVar.set_thumbnail(url="https://cdn.discordapp.com/attachments/803372407133962251/803380642891956324/new-moon_1f311.png")
-        embedVar.add_field(name="New Moon", value=("position: " + str(roundedpos)), inline=False)
-    elif index == 1:
-        embedVar.set_thumbnail(url="https://cdn.discordapp.com/attachments/803372407133962251/803380679379124244/waxing-crescent-moon_1f312.png")
-        embedVar.add_field(name="Waxing Crescent", value=("position: " + str(roundedpos)), inline=False)
-    elif index == 2:
-        embedVar.set_thumbnail(url="https://cdn.discordapp.com/attachments/803372407133962251/803380815592816670/first-quarter-moon_1f313.png")
-        embedVar.add_field(name="First Quarter", value=("position: " + str(roundedpos)), inline=False)
-    elif index == 3:
-        embedVar.set_thumbnail(url="https://cdn.discordapp.com/attachments/803372407133962251/803380906005495818/waxing-gibbous-moon_1f314.png")
-        embedVar.add_field(name="Waxing Gibbous", value=("position: " + str(roundedpos)), inline=False)
-    elif index == 4:
-        embedVar.set_thumbnail(url="https://cdn.discordapp.com/attachments/803372407133962251/803380926306189333/full-moon_1f315.png")
-        embedVar.add_field(name="Full Moon", value=("position: " + str(roundedpos)), inline=False)
-    elif index == 5:
-        embedVar.set_thumbnail(url="https://cdn.discordapp.com/attachments/803372407133962251/803380946149703730/waning-gibbous-moon_1f316.png")
-        embedVar.add_field(name="Waning Gibbous", value=("position: " + str(roundedpos)), inline=False)
-    elif index == 6:
-        embedVar.set_thumbnail(url="https://cdn.discordapp.com/attachments/803372407133962251/803380969310650378/last-quarter-moon_1f317.png")
-        embedVar.add_field(name="Last Quarter", value=("position: " + str(roundedpos)), inline=False)
-    elif index == 7:
-        embedVar.set_thumbnail(url="https://cdn.discordapp.com/attachments/803372407133962251/803380991019188244/waning-crescent-moon_1f318.png")
-        embedVar.add_field(name="Waning Crescent", value=("position: " + str(roundedpos)), inline=False)
+async def moonie(ctx, arg: str = None):
+    now = numpy.datetime64(datetime.datetime.utcnow().replace(microsecond=0))
+
+    if arg is not None and (arg.lower() == "month" or len(arg) == 7):
+        try:
+            month = now.astype('datetime64[M]') if arg.lower() == "month" else numpy.datetime64(arg, 'M')
+            year, monthnum = divmod(int(month.astype(int)), 12)
+            year, monthnum = year + 1970, monthnum + 1
+            if not datetime.MINYEAR <= year <= datetime.MAXYEAR: #numpy takes years Python's dates can't hold
+                raise ValueError(arg)
+        except ValueError:
+            await ctx.send("Error, that isn't a month I recognize. Use `month` or a month like `2026-12`.")
+            return
+        embedVar = discord.Embed(title=datetime.date(year, monthnum, 1).strftime("Moon Phases for %B %Y"), description=moonCalendar(year, monthnum), color=0x404040)
+        await ctx.send(embed=embedVar)
+        return
+
+    when = now
+    title = "Current Moon Phase"
+    if arg is not None:
+        try:
+            when = numpy.datetime64(arg, 'D') + numpy.timedelta64(12, 'h')
+        except ValueError:
+            await ctx.send("Error, that isn't a date I recognize. Use a date like `2026-12-25`, or `month` for a calendar.")
+            return
+        title = "Moon Phase for " + str(when.astype('datetime64[D]'))
+
+    pos = float(moonpos(when))
+    name, emoji, thumbnail = MOON_PHASES[int(moonPhaseIndex(pos))]
+    nextNew, nextFull = moonNext(when, pos)
+
+    embedVar = discord.Embed(title=title, color=0x404040)
+    embedVar.set_thumbnail(url=thumbnail)
+    embedVar.add_field(name=name, value=("position: " + str(round(pos, 3))), inline=False)
+    embedVar.add_field(name="Illumination:", value=(str(round(float(moonIllumination(pos)) * 100)) + "%"), inline=True)
+    embedVar.add_field(name="Next New Moon:", value=str(nextNew.astype('datetime64[D]')), inline=True)
+    embedVar.add_field(name="Next Full Moon:", value=str(nextFull.astype('datetime64[D]')), inline=True)
     await ctx.send(embed=embedVar)
 
 
@@ -851,27 +2558,22 @@ async def changedefault(ctx, defaultType, newDefault):
     if defaultType is None:
         await ctx.send("You need to provide what argument you want to change *and* the new value")
         return
-    if defaultType == "serverID":
+    if defaultType in ("serverID", "schemaVersion"):
         await ctx.send("No one is permitted to alter this value, as it would compromise bot functionality.")
         return
     # This command will allow admins to set the timezone and channel to update for the bot's clock function
     if (str(ctx.message.author.id) == str(OwnerID)) or (ctx.message.author.mention == discord.Permissions.administrator):
-        with open('Resident-Clock-Defaults.json') as json_file:
-            data = json.load(json_file)
-        for idx, d in enumerate(data['per_server']):
-            if d['serverID'] == ctx.message.guild.id:
-                if defaultType not in data['per_server'][idx]:
-                    ctx.send("Invalid Default Type, this is not a type that exists.")
-                else:
-                    temp = data['per_server'][idx][defaultType]
-                    data['per_server'][idx][defaultType] = newDefault
-        with open('Resident-Clock-Defaults.json', 'w') as outfile:
-            json.dump(data, outfile)
-        embedVar = discord.Embed(title="Default Value Altered:", description=("**" + defaultType + "**\nOld: " + temp + "\nNew: " + str(newDefault)), color=0x02f513)
+        entry = settings.entry(ctx.message.guild.id)
+        if entry is None or defaultType not in entry:
+            await ctx.send("Invalid Default Type, this is not a type that exists.")
+            return
+        temp = entry[defaultType]
+        settings.update(ctx.message.guild.id, {defaultType: newDefault})
+        embedVar = discord.Embed(title="Default Value Altered:", description=("**" + defaultType + "**\nOld: " + str(temp) + "\nNew: " + str(newDefault)), color=0x02f513)
         await ctx.send(embed=embedVar)
         return
     else:
-        ctx.send("You lack the required permissions to change these settings. Please contact an Admin for help.")
+        await ctx.send("You lack the required permissions to change these settings. Please contact an Admin for help.")
         return
 
 #Requires Admin, enables assignment of a clocktower channel
@@ -879,25 +2581,16 @@ async def changedefault(ctx, defaultType, newDefault):
 async def assigntime(ctx, channelID, offset):
     #This command will allow admins to set the timezone and channel to update for the bot's clock function
     if (str(ctx.message.author.id) == str(OwnerID)) or (ctx.message.author.mention == discord.Permissions.administrator):
-        with open('Resident-Clock-Defaults.json') as json_file:
-            data = json.load(json_file)
-        print("file opened, proceeding to check server lists")
-        for idx, d in enumerate(data['per_server']):
-            #print(d['serverID'])
-            #print(ctx.message.guild.id)
-            if d['serverID'] == ctx.message.guild.id:
-                data['per_server'][idx]['Timezone'] = offset
-                if channelID.lower() == "none":
-                    data['per_server'][idx]['ClockChannel'] = None
-                else:
-                    data['per_server'][idx]['ClockChannel'] = channelID
-        with open('Resident-Clock-Defaults.json', 'w') as outfile:
-            json.dump(data, outfile)
-            print("wrote to file")
+        if getTz(offset) is None:
+            await ctx.send("Error, the timezone must be an hour offset like `-8` or `5.5`, or a zone name like `America/Vancouver`.")
+            return
+        if channelID.lower() == "none":
+            channelID = None
+        settings.update(ctx.message.guild.id, {'Timezone': offset, 'ClockChannel': channelID})
         embedVar = discord.Embed(title="Added Clock Tower:", description=(str(channelID) + ", " + str(offset)), color=0x02f513)
         await ctx.send(embed=embedVar)
     else:
-        ctx.send("You lack the required permissions to change these settings. Please contact an Admin for help.")
+        await ctx.send("You lack the required permissions to change these settings. Please contact an Admin for help.")
 
 
 #################################################
@@ -905,30 +2598,104 @@ async def assigntime(ctx, channelID, offset):
 ############## Owner-only commands ##############
 
 
-#Owner-only command. Used as a security precaution. Prints all servers the bot is in.
+#Owner-only command. Used as a security precaution. Lists the servers the bot is in, one page at a time.
+#Options can go in any order: a page number, "members" or "joined" to change the sort, "min=<members>", "clock" for servers
+#using the clocktower, and "all" to get every matching server as a text file instead of a page.
 @bot.command(name='serverlist')
-async def servers(ctx):
+async def servers(ctx, *options):
     if str(ctx.message.author.id) == str(OwnerID):
-        activeservers = bot.guilds
-        description = ""
-        for guild in activeservers:
-            description += (guild.name + "\n")
-            #print(guild)
-            #print(guild.name + ": " + guild.id)
-        embedVar = discord.Embed(title="Here is a list of all servers that I am a member of:", description=description, color=0x404040)
+        page, sort, minMembers, clockOnly, everything = 1, "name", 0, False, False
+        for option in options:
+            option = option.lower()
+            if option.isdigit():
+                page = int(option)
+            elif option in ("name", "members", "joined"):
+                sort = option
+            elif option.startswith("min=") and option[4:].isdigit():
+                minMembers = int(option[4:])
+            elif option == "clock":
+                clockOnly = True
+            elif option == "all":
+                everything = True
+        guilds = fleet.select(sort, minMembers, clockOnly)
+
+        if everything:
+            text = "\n".join(str(guild.id) + "\t" + str(guild.member_count or 0) + "\t" + str(guild.name) for guild in guilds)
+            await ctx.send(str(len(guilds)) + " servers:", file=discord.File(io.BytesIO(text.encode()), filename="servers.tsv"))
+            return
+
+        pages = max(1, math.ceil(len(guilds) / FLEET_PAGE_SIZE))
+        page = min(max(page, 1), pages)
+        description = "\n".join(fleetLine(guild) for guild in guilds[(page - 1) * FLEET_PAGE_SIZE:page * FLEET_PAGE_SIZE])
+        embedVar = discord.Embed(title="Here is a list of all servers that I am a member of:", description=(description or "No servers match."), color=0x404040)
+        embedVar.set_footer(text=("Page " + str(page) + " of " + str(pages) + ", " + str(len(guilds)) + " of " + str(len(fleet.byID)) + " servers"))
         await ctx.send(embed=embedVar)
 
-#Owner-only command. Allows the bot to remotely leave a server without the owner necesarrily sharing the server with the bot
+#Owner-only command. Allows the bot to remotely leave a server without the owner necesarrily sharing the server with the bot.
+#Takes a server ID or a name. When several servers share a name they're listed so the right one can be picked by ID.
 @bot.command(name='emergencyleave')
 async def emergencykick(ctx, *, guild_name):
     if str(ctx.message.author.id) == str(OwnerID):
-        guild = discord.utils.get(bot.guilds, name=guild_name)
-        if guild is None:
+        matches = fleet.find(guild_name)
+        if not matches:
             await ctx.send("I don't recognize that guild.")
             return
+        if len(matches) > 1:
+            description = "\n".join(fleetLine(guild) for guild in matches[:FLEET_PAGE_SIZE])
+            embedVar = discord.Embed(title=(str(len(matches)) + " servers are called that, use the ID of the one to leave:"), description=description, color=0x404040)
+            await ctx.send(embed=embedVar)
+            return
+        guild = matches[0]
         await bot.http.leave_guild(guild_id=guild.id)
         await ctx.send(f":ok_hand: Left guild: {guild.name} ({guild.id})")
 
+#Owner-only command. Shows the slowest commands and upstream APIs along with cache hit rates and queue depths. The full set of numbers is on the metrics page.
+@bot.command(name='stats')
+async def stats(ctx):
+    if str(ctx.message.author.id) == str(OwnerID):
+        embedVar = discord.Embed(title="Resident Clock stats", description=("Up for " + str(datetime.timedelta(seconds=int(monotonic() - metrics.started))) + ", in " + str(len(bot.guilds)) + " servers"), color=0x404040)
+        for title, name, label in (("Commands", 'command_seconds', 'command'), ("Upstream APIs", 'upstream_seconds', 'api')):
+            rows = sorted(metrics.series(name), key=lambda row: -row[1].percentile(0.99))[:10]
+            lines = [labels[label] + ": " + str(histogram.count) + " calls, p50 " + str(round(histogram.percentile(0.5) * 1000)) + "ms, p99 " + str(round(histogram.percentile(0.99) * 1000)) + "ms" for labels, histogram in rows]
+            embedVar.add_field(name=title, value=("\n".join(lines) or "Nothing yet"), inline=False)
+        lines = []
+        for cache in (forecastCache, aqiCache, leaderboardCache):
+            hits = metrics.counter('cache_requests_total', cache=cache.name, result="hit")
+            total = hits + metrics.counter('cache_requests_total', cache=cache.name, result="miss") + metrics.counter('cache_requests_total', cache=cache.name, result="stale")
+            lines.append(cache.name + ": " + (str(round(100 * hits / total)) + "% hits of " + str(total) if total else "unused") + ", " + str(len(cache.entries)) + " entries")
+        embedVar.add_field(name="Caches", value="\n".join(lines), inline=False)
+        ticks = metrics.series('clock_tick_drift_seconds')
+        drift = (str(round(ticks[0][1].percentile(0.5), 3)) + "s median drift") if ticks else "no ticks yet"
+        queued = ", ".join(name + " " + str(quotas.depth(name)) for name in QUOTA_LIMITS)
+        embedVar.add_field(name="Queues", value=("Clock edits pending: " + str(clockEdits.depth()) + " (" + drift + ")\nWaiting on API budget: " + queued), inline=False)
+        await ctx.send(embed=embedVar)
+
+#Owner-only command. Profiles the running bot for a number of seconds and uploads the report, see SamplingProfiler
+@bot.command(name='profile')
+async def profile(ctx, seconds: int = 30):
+    if str(ctx.message.author.id) == str(OwnerID):
+        if profiler.running:
+            await ctx.send("A profile is already running.")
+            return
+        seconds = min(max(seconds, 1), PROFILE_MAX_SECONDS)
+        await ctx.send("Profiling for " + str(seconds) + " seconds...")
+        stacks = await profiler.run(seconds)
+        report = profiler.report(stacks, seconds)
+        summary = "\n\n".join(report.split("\n\n")[:2])[:1900] #the headline and the top functions, the rest is in the file
+        await ctx.send("```" + summary + "```", file=discord.File(io.BytesIO(report.encode()), filename="profile.txt"))
+
+#Owner-only command. Shows whether each background task is running and how often it has crashed
+@bot.command(name='tasks')
+async def tasks(ctx):
+    if str(ctx.message.author.id) == str(OwnerID):
+        embedVar = discord.Embed(title="Background tasks", color=0x404040)
+        for name, status, restarts, error, uptime in supervisor.status():
+            value = status + (" for " + str(datetime.timedelta(seconds=int(uptime))) if uptime is not None else "") + "\nRestarts: " + str(restarts)
+            if error is not None:
+                value += "\nLast error: " + error[:200]
+            embedVar.add_field(name=name, value=value, inline=False)
+        await ctx.send(embed=embedVar)
+
 #Owner-only command. Enables the bot owner to speak through the bot. The bot will take the given input, delete the original message, and echo what it said.
 @bot.command(name='speak')
 async def speak(ctx, *, arg):
@@ -942,16 +2709,7 @@ async def speak(ctx, *, arg):
 @bot.command(name='q_add')
 async def quoteadd(ctx, *, arg):
     if str(ctx.message.author.id) == str(OwnerID):
-        with open('Resident-Clock-Quotes.json') as json_file:
-            data = json.load(json_file)
-            temp = data['quotes']
-            quotenum = len(temp)
-            quote = {
-                (quotenum + 1): arg
-            }
-            data['quotes'].append(quote)
-            with open('Resident-Clock-Quotes.json', 'w') as outfile:
-                json.dump(data, outfile)
+        await quotes.add(arg)
         embedVar = discord.Embed(title="Quote added:", description=(arg), color=0x02f513)
         await ctx.send(embed=embedVar)
     else:
@@ -961,4 +2719,6 @@ async def quoteadd(ctx, *, arg):
 #################################################
 
 
-bot.run(Bot_Token) #The greatest demonstration that size doesn't matter
+#only connect when run directly, so the benchmark can import the commands without logging in
+if __name__ == '__main__':
+    bot.run(Bot_Token) #The greatest demonstration that size doesn't matter